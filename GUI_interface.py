@@ -13,9 +13,13 @@ from tkinter import messagebox
 import customtkinter as ctk
 from packaging.version import parse
 
+import async_utils
+import audio_utils
 import openai_agi
 import openai_audio
+import openai_client
 import openai_text
+import transcript_utils
 
 # Set the theme for customtkinter
 ctk.set_appearance_mode("Dark")
@@ -79,6 +83,9 @@ class LeftPanelFrame(ctk.CTkFrame):
         self.setup_run_button()
         self.transcription_manager = TranscriptionManager()
         self.transcription_manager.set_callback(self.on_transcription_complete)
+        self.transcription_manager.set_progress_callback(
+            self.on_transcription_progress
+        )
         self.completion_manager = CompletionManager()
         self.selected_file_path = None
         self.selected_language_code = None
@@ -291,6 +298,12 @@ class LeftPanelFrame(ctk.CTkFrame):
             messagebox.showwarning("Warning", "Please select a language.")
             return
 
+        if hasattr(self, "transcription_output_frame"):
+            # Clear the previous output, new text is appended as segments complete
+            self.transcription_output_frame.transcription_output_text.delete(
+                "1.0", "end"
+            )
+
         # Use final_prompt for transcription
         final_prompt_text = self.final_prompt if self.final_prompt else ""
         self.transcription_manager.start_transcription(
@@ -304,6 +317,15 @@ class LeftPanelFrame(ctk.CTkFrame):
         final_prompt_text = self.final_prompt if self.final_prompt else ""
         self.completion_manager.start_completion()
 
+    def on_transcription_progress(self, transcription_text):
+        if hasattr(self, "transcription_output_frame"):
+            # Append the new text from the main thread
+            self.transcription_output_frame.after(
+                0,
+                self.transcription_output_frame.append_transcription_text,
+                transcription_text,
+            )
+
     def on_transcription_complete(self):
         if hasattr(self, "transcription_output_frame"):
             # Call a method in TranscriptionOutputFrame to update its content
@@ -316,10 +338,17 @@ class LeftPanelFrame(ctk.CTkFrame):
 
         self.completion_manager = CompletionManager()
         self.completion_manager.set_callback(self.on_completion_complete)
+        self.completion_manager.set_delta_callback(self.on_completion_delta)
         self.completion_manager.start_completion(
             combined_input, "", "gpt-4-1106-preview"
         )
 
+    def on_completion_delta(self, delta):
+        # Append the streamed text from the main thread
+        self.transcription_output_frame.after(
+            0, self.transcription_output_frame.append_output_text, delta
+        )
+
     def on_completion_complete(self):
         # Update the transcription output frame with the completion result
         completion_text = self.completion_manager.completion
@@ -384,6 +413,17 @@ class TranscriptionOutputFrame(ctk.CTkFrame):
         if completion:
             self.transcription_output_text.insert("end", completion)
 
+    def append_transcription_text(self, text):
+        # Method to append a new piece of transcription while the rest is in flight
+        if self.transcription_output_text.get("1.0", "end-1c"):
+            text = " " + text
+        self.append_output_text(text)
+
+    def append_output_text(self, text):
+        # Method to append streamed text at the end of the text box
+        self.transcription_output_text.insert("end", text)
+        self.transcription_output_text.see("end")
+
     def setup_save_button(self):
         self.save_button = ctk.CTkButton(
             self, text="Save", command=self.save_transcription
@@ -425,11 +465,16 @@ class CompletionManager:
         self.completion = None
         self.is_completing = False
         self.callback = None
+        self.delta_callback = None
 
     def set_callback(self, callback):
         """Set a callback function to be called after completion."""
         self.callback = callback
 
+    def set_delta_callback(self, delta_callback):
+        """Set a callback function to be called with each piece of text as it streams in."""
+        self.delta_callback = delta_callback
+
     def start_completion(self, input_text, system_prompt, model="gpt-3.5-turbo"):
         if self.is_completing:
             messagebox.showinfo("Info", "Completion is already in progress.")
@@ -438,21 +483,25 @@ class CompletionManager:
         self.is_completing = True
         print("Completion started.")
 
-        # Run completion in a separate thread
-        completion_thread = threading.Thread(
-            target=self.run_completion,
-            args=(input_text, system_prompt, model),
-            daemon=True,  # Optional: make this thread a daemon thread
+        # Stream the completion on the shared event loop
+        completion_future = async_utils.submit(
+            self.stream_completion(input_text, system_prompt, model)
         )
-        completion_thread.start()
+        completion_future.add_done_callback(self.on_completion_done)
+
+    async def stream_completion(self, input_text, system_prompt, model):
+        deltas = []
+        async for delta in openai_text.astream_completion(
+            model, input_text, system_prompt
+        ):
+            deltas.append(delta)
+            if self.delta_callback:
+                self.delta_callback(delta)
+        return "".join(deltas)
 
-    def run_completion(self, input_text, system_prompt, model):
+    def on_completion_done(self, completion_future):
         try:
-            self.completion = openai_text.openai_completion(
-                model,
-                input_text,
-                system_prompt,
-            )
+            self.completion = completion_future.result()
         except Exception as e:
             logging.error(f"Failed to start completion: {e}", exc_info=True)
             messagebox.showerror("Error", f"Failed to start completion: {e}")
@@ -473,11 +522,16 @@ class TranscriptionManager:
         self.transcription = None
         self.is_transcribing = False
         self.callback = None  # Initialize the callback attribute
+        self.progress_callback = None
 
     def set_callback(self, callback):
         """Set a callback function to be called after transcription."""
         self.callback = callback
 
+    def set_progress_callback(self, progress_callback):
+        """Set a callback function to be called with each new piece of transcription, in order."""
+        self.progress_callback = progress_callback
+
     def start_transcription(
         self, selected_file_path, selected_language_code, prompt_text
     ):
@@ -498,18 +552,31 @@ class TranscriptionManager:
         self, selected_file_path, selected_language_code, prompt_text
     ):
         try:
-            openai_api_key, openai_org = openai_agi.load_environment_variables()
-            client = openai_agi.initialize_openai_client(openai_api_key, openai_org)
+            client = openai_client.get_client()
             if not selected_file_path or not selected_language_code:
                 raise ValueError("File path or language code is not set")
 
-            self.transcription = openai_audio.transcribe_audio(
+            segments, _ = audio_utils.stream_segments(
                 selected_file_path,
+                60 * 1000,
+                None,
+                encoding=audio_utils.upload_encoding("ogg"),
+                search_radius_ms=2000,
+            )
+            merger = transcript_utils.TranscriptMerger("text")
+            for _, transcription_data in openai_audio.iter_transcriptions(
+                segments,
                 client,
                 selected_language_code,
                 prompt_text,
                 "text",
-            )
+            ):
+                if transcription_data is None:
+                    continue
+                merger.add(transcription_data)
+                self.transcription = merger.result()
+                if self.progress_callback:
+                    self.progress_callback(transcription_data)
         except Exception as e:
             logging.error(f"Failed to start transcription: {e}", exc_info=True)
             messagebox.showerror("Error", f"Failed to start transcription: {e}")
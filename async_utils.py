@@ -0,0 +1,82 @@
+import asyncio
+import queue
+import threading
+
+# Maximum number of concurrent requests per OpenAI endpoint, see rate_limiter
+ENDPOINT_CONCURRENCY = {
+    "audio.transcriptions": 50,
+    "audio.speech": 10,
+    "chat.completions": 20,
+}
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """
+    Returns the process-wide event loop, started on first use in a daemon thread.
+
+    Every coroutine of the async engine runs on this single loop, so one process
+    can keep hundreds of requests in flight without a thread per request.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="openai-event-loop", daemon=True
+            ).start()
+    return _loop
+
+
+def submit(coroutine):
+    """
+    Schedules a coroutine on the shared event loop.
+
+    :return: A concurrent.futures.Future usable from any thread.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+
+
+def run_sync(coroutine):
+    """
+    Runs a coroutine on the shared event loop and blocks until its result.
+    Sync wrappers use this, so it must not be called from the loop itself.
+    """
+    return submit(coroutine).result()
+
+
+def set_concurrency(endpoint, limit):
+    """
+    Changes the maximum concurrency of an endpoint (see rate_limiter.RateLimiter).
+    """
+    ENDPOINT_CONCURRENCY[endpoint] = limit
+
+
+def iterate_sync(async_iterable):
+    """
+    Iterates an async iterable running on the shared event loop from sync code.
+
+    Items are handed over through a queue as soon as they are produced.
+    """
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in async_iterable:
+                items.put((item, None))
+        except Exception as e:
+            items.put((done, e))
+            return
+        items.put((done, None))
+
+    submit(pump())
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
@@ -1,54 +1,594 @@
+import hashlib
+import io
 import os
 import shutil
+import subprocess
+import threading
+from collections import deque
 from pathlib import Path
 
+import numpy as np
 from pydub import AudioSegment
+from pydub.utils import get_encoder_name, mediainfo
+
+import metrics
+
+
+# Numpy dtype matching each pydub sample width (pydub stores 24-bit audio as 32-bit)
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+# Function to read the raw samples of an audio segment without copying them
+def audio_samples(sound):
+    return np.frombuffer(sound.raw_data, dtype=SAMPLE_DTYPES[sound.sample_width])
+
+
+# Function to compute the loudness of every chunk of an audio segment in one pass
+def frame_dbfs(sound, chunk_size=10):
+    """
+    Computes the dBFS of successive chunk_size-millisecond frames of a sound.
+
+    Equivalent to ``[sound[i : i + chunk_size].dBFS for i in range(0, len(sound), chunk_size)]``
+    but reads the sample buffer once instead of slicing the AudioSegment per frame.
+    Frame boundaries are placed like pydub's millisecond slicing, so frames stay
+    aligned on long files at rates that are not a multiple of 1000 / chunk_size
+    (e.g. 22050 Hz); only the silence pydub pads the last frame with is ignored.
+
+    :param sound: The pydub AudioSegment to analyse.
+    :param chunk_size: The frame length in milliseconds.
+    :return: A numpy array with one dBFS value per frame (-inf for digital silence).
+    """
+    assert chunk_size > 0
+    samples = audio_samples(sound)
+    if sound.frame_rate * chunk_size < 1000 or len(samples) == 0:
+        return np.full(0, -np.inf)
+    # First sample of each frame: int(i * frame_rate / 1000) frames, as in pydub
+    frame_starts = np.arange(0, len(sound), chunk_size) * sound.frame_rate // 1000
+    starts = frame_starts * sound.channels
+    starts = starts[starts < len(samples)]
+    squares = np.square(samples, dtype=np.float64)
+    sums = np.add.reduceat(squares, starts)
+    counts = np.diff(np.append(starts, len(samples)))
+    rms = np.sqrt(sums / counts)
+    with np.errstate(divide="ignore"):
+        return 20 * np.log10(rms / sound.max_possible_amplitude)
 
 
 # Function to detect leading silence
 def milliseconds_until_sound(sound, silence_threshold_in_decibels=-20.0, chunk_size=10):
-    trim_ms = 0  # ms
     assert chunk_size > 0  # to avoid infinite loop
-    while sound[
-        trim_ms : trim_ms + chunk_size
-    ].dBFS < silence_threshold_in_decibels and trim_ms < len(sound):
-        trim_ms += chunk_size
-    return trim_ms
+    loud_frames = np.flatnonzero(
+        frame_dbfs(sound, chunk_size) >= silence_threshold_in_decibels
+    )
+    if len(loud_frames):
+        return int(loud_frames[0]) * chunk_size
+    # No sound at all: behave like the frame-by-frame scan reaching the end
+    return -(-len(sound) // chunk_size) * chunk_size
+
+
+# Function to find the quietest point of a range from a loudness envelope
+def quietest_point(envelope, start_ms, end_ms, window_ms=50):
+    """
+    Returns the middle of the quietest envelope window between start_ms and end_ms.
+
+    :param envelope: Per-window dBFS values, as returned by frame_dbfs(sound, window_ms).
+    :param start_ms: Start of the search range in milliseconds.
+    :param end_ms: End of the search range in milliseconds.
+    :param window_ms: The envelope window length in milliseconds.
+    :return: The cut position in milliseconds.
+    """
+    first = start_ms // window_ms
+    last = max(first + 1, min(len(envelope), end_ms // window_ms))
+    quietest = first + int(np.argmin(envelope[first:last]))
+    return min(end_ms, max(start_ms, quietest * window_ms + window_ms // 2))
+
+
+# Function to place segment boundaries in the silences near regular targets
+def silence_cut_points(
+    audio, segment_duration_ms, start_ms=0, search_radius_ms=2000, window_ms=50
+):
+    """
+    Computes segment boundaries aligned on silences instead of fixed-length cuts.
+
+    Near every target boundary (segment_duration_ms after the previous cut) the
+    quietest window_ms window within search_radius_ms is chosen, so words are
+    not split at the seams. The loudness envelope is computed once for the file.
+
+    :param audio: The decoded AudioSegment.
+    :param segment_duration_ms: The target segment length in milliseconds.
+    :param start_ms: Position of the first boundary (e.g. the trim offset).
+    :param search_radius_ms: How far from the target a cut may move.
+    :param window_ms: The loudness envelope resolution in milliseconds.
+    :return: The list of boundaries, from start_ms to len(audio).
+    """
+    envelope = frame_dbfs(audio, window_ms)
+    cuts = [start_ms]
+    while cuts[-1] + segment_duration_ms + search_radius_ms < len(audio):
+        target = cuts[-1] + segment_duration_ms
+        cuts.append(
+            quietest_point(
+                envelope,
+                # Never more than half a segment back, so no segment is shorter
+                max(cuts[-1] + segment_duration_ms // 2, target - search_radius_ms),
+                target + search_radius_ms,
+                window_ms,
+            )
+        )
+    cuts.append(len(audio))
+    return cuts
+
+
+# Function to decode an audio file and locate the end of its leading silence
+def load_audio(filepath, trim=True):
+    """
+    Decodes an audio file once and returns it with the offset where the sound starts.
+
+    Slicing from the offset is left to the caller, so the decoded buffer is never
+    copied just to drop the leading silence.
+
+    :param filepath: Path to the audio file.
+    :param trim: Whether to look for leading silence (offset is 0 otherwise).
+    :return: The decoded AudioSegment and the trim offset in milliseconds.
+    """
+    with metrics.span("decode", file=os.path.basename(filepath)):
+        audio = AudioSegment.from_file(filepath)
+    with metrics.span("trim"):
+        start_trim = milliseconds_until_sound(audio) if trim else 0
+    return audio, start_trim
 
 
 # Function to trim the start of an audio file
-def trim_start(filepath):
-    path = Path(filepath)
-    directory = path.parent
-    filename = path.stem
-    trimmed_directory = directory / filename
-    trimmed_directory.mkdir(parents=True, exist_ok=True)
-    audio = AudioSegment.from_file(filepath)
-    start_trim = milliseconds_until_sound(audio)
+def trim_start(filepath, export=False):
+    """
+    Trims the leading silence of an audio file in memory.
+
+    :param filepath: Path to the audio file.
+    :param export: Also write the trimmed audio as a WAV file next to the input.
+    :return: The trimmed AudioSegment and the path of the exported file (None if not exported).
+    """
+    audio, start_trim = load_audio(filepath)
     trimmed_audio = audio[start_trim:]
-    trimmed_filename = trimmed_directory / f"trimmed_{path.name}"
-    print(trimmed_filename)
-    trimmed_audio.export(trimmed_filename, format="wav")
-    trimmed_audio = AudioSegment.from_file(trimmed_filename)
-    shutil.rmtree(trimmed_directory)
+    trimmed_filename = None
+    if export:
+        path = Path(filepath)
+        trimmed_filename = path.parent / f"trimmed_{path.stem}.wav"
+        trimmed_audio.export(trimmed_filename, format="wav")
+        print(trimmed_filename)
     return trimmed_audio, trimmed_filename
 
 
-# Function to segment an audio file
-def segment_audio(trimmed_audio, segment_duration_ms, output_dir):
+# Upload request size limit of the transcription endpoint
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+
+# Upload encodings: pydub export format, ffmpeg codec and default bitrate
+UPLOAD_ENCODINGS = {
+    "wav": {"format": "wav", "codec": None, "bitrate": None},
+    "ogg": {"format": "ogg", "codec": "libopus", "bitrate": "24k"},
+    "mp3": {"format": "mp3", "codec": None, "bitrate": "48k"},
+}
+
+
+# Function to describe how segments are encoded before upload
+def upload_encoding(format="ogg", bitrate=None, sample_rate=16000, channels=1):
+    """
+    Builds the encoding settings used by segment_audio.
+
+    :param format: One of UPLOAD_ENCODINGS ('wav' keeps uncompressed PCM).
+    :param bitrate: Target bitrate such as '24k' (defaults to the format's bitrate).
+    :param sample_rate: Resampling rate in Hz (None keeps the original rate).
+    :param channels: Number of output channels (None keeps the original layout).
+    :return: A dictionary of encoding settings.
+    """
+    encoding = dict(UPLOAD_ENCODINGS[format])
+    encoding["bitrate"] = bitrate or encoding["bitrate"]
+    encoding["sample_rate"] = sample_rate
+    encoding["channels"] = channels
+    return encoding
+
+
+# Function to estimate how many encoded bytes one millisecond of audio takes
+def encoded_bytes_per_ms(audio, encoding):
+    if encoding["bitrate"]:
+        return int(encoding["bitrate"].rstrip("k")) * 1000 / 8 / 1000
+    frame_rate = encoding["sample_rate"] or audio.frame_rate
+    channels = encoding["channels"] or audio.channels
+    return frame_rate * channels * audio.sample_width / 1000
+
+
+# Function to find the longest segment that fits in the upload byte budget
+def max_segment_duration_ms(audio, encoding, max_bytes=MAX_UPLOAD_BYTES, margin=0.9):
+    return int(max_bytes * margin / encoded_bytes_per_ms(audio, encoding))
+
+
+# Function to downmix, resample and compress a segment before upload
+def encode_segment(segment, encoding):
+    if encoding["channels"]:
+        segment = segment.set_channels(encoding["channels"])
+    if encoding["sample_rate"]:
+        segment = segment.set_frame_rate(encoding["sample_rate"])
+    return segment
+
+
+# Function to encode an audio segment into an in-memory file
+def export_to_buffer(segment, name, format="wav", codec=None, bitrate=None):
+    buffer = io.BytesIO()
+    segment.export(buffer, format=format, codec=codec, bitrate=bitrate)
+    buffer.name = name  # Used by the upload to detect the audio format
+    buffer.seek(0)
+    return buffer
+
+
+# Function to report how much the upload encoding saved
+def report_encoding_savings(raw_bytes, encoded_bytes):
+    saved = raw_bytes - encoded_bytes
+    ratio = saved / raw_bytes * 100 if raw_bytes else 0
+    print(
+        f"Upload encoding: {raw_bytes / 1e6:.1f} MB -> {encoded_bytes / 1e6:.1f} MB "
+        f"(saved {saved / 1e6:.1f} MB, {ratio:.0f}%)"
+    )
+    return saved
+
+
+# Function to create the folder receiving segments written to disk
+def make_segments_dir(output_dir):
     segments_dir = os.path.join(output_dir, "segments")
     if not os.path.exists(segments_dir):
         os.makedirs(segments_dir)
+    return segments_dir
 
-    segments = []
-    for i in range(0, len(trimmed_audio), segment_duration_ms):
-        segment = trimmed_audio[i : i + segment_duration_ms]
-        segment_filename = os.path.join(segments_dir, f"segment_{i // 1000:02d}.wav")
-        segment.export(segment_filename, format="wav")
-        segments.append(segment_filename)
+
+# Path of a segment written to disk, carrying its offset like in-memory segments
+class SegmentPath(str):
+    offset_ms = 0
+    duration_ms = None
+    audio_digest = None
+
+
+# Function hashing the samples of a segment and the settings they are encoded with
+def pcm_digest(segment, encoding):
+    """
+    Identifies the audio of an encoded segment.
+
+    Encoders such as ogg/opus write a random stream serial, so the encoded bytes
+    of the same audio differ from one run to the next; the PCM samples do not.
+    """
+    digest = hashlib.sha256()
+    digest.update(
+        repr(
+            (
+                segment.frame_rate,
+                segment.channels,
+                segment.sample_width,
+                encoding["format"],
+                encoding["codec"],
+                encoding["bitrate"],
+            )
+        ).encode()
+    )
+    digest.update(segment.raw_data)
+    return digest.hexdigest()
+
+
+# Function to encode one segment and keep it in memory or write it to disk
+def store_segment(segment, name, encoding, segments_dir=None, offset_ms=0):
+    """
+    Encodes a segment for upload.
+
+    The returned segment has an offset_ms attribute: its position in the original
+    recording (trim offset included), used to stitch timestamps back together,
+    a duration_ms attribute, used by the planner to learn request latency, and
+    an audio_digest attribute, used as the transcription cache key.
+
+    :return: The segment (BytesIO or SegmentPath) and its encoded size in bytes.
+    """
+    with metrics.span("encode", segment=name, format=encoding["format"]) as span:
+        encoded = encode_segment(segment, encoding)
+        digest = pcm_digest(encoded, encoding)
+        buffer = export_to_buffer(
+            encoded,
+            name,
+            encoding["format"],
+            encoding["codec"],
+            encoding["bitrate"],
+        )
+        encoded_bytes = span["bytes"] = buffer.getbuffer().nbytes
+    if segments_dir is None:
+        buffer.offset_ms = offset_ms
+        buffer.duration_ms = len(segment)
+        buffer.audio_digest = digest
+        return buffer, encoded_bytes
+    segment_filename = SegmentPath(os.path.join(segments_dir, name))
+    segment_filename.offset_ms = offset_ms
+    segment_filename.duration_ms = len(segment)
+    segment_filename.audio_digest = digest
+    with open(segment_filename, "wb") as segment_file:
+        segment_file.write(buffer.getbuffer())
+    return segment_filename, encoded_bytes
+
+
+# Function to segment an audio file
+def segment_audio(
+    trimmed_audio,
+    segment_duration_ms,
+    output_dir,
+    start_ms=0,
+    to_disk=False,
+    encoding=None,
+    search_radius_ms=0,
+    overlap_ms=0,
+):
+    """
+    Cuts an audio segment into successive segment_duration_ms-long segments.
+
+    Segments are kept in memory as named BytesIO files unless to_disk is set,
+    in which case they are written under output_dir/segments. The segment
+    duration is capped so that no encoded segment exceeds the upload limit.
+    With search_radius_ms, each cut moves to the quietest point within that
+    radius of its target (see silence_cut_points). With overlap_ms, every segment
+    also includes the first overlap_ms of the next one, for seam de-duplication
+    (see transcript_utils.stitch_overlap).
+
+    :param trimmed_audio: The decoded AudioSegment.
+    :param segment_duration_ms: The length of each segment in milliseconds.
+    :param output_dir: The directory receiving the segments folder when to_disk is set.
+    :param start_ms: Offset of the first segment (e.g. the trim offset).
+    :param to_disk: Write the segments as files instead of in-memory buffers.
+    :param encoding: Settings from upload_encoding (defaults to uncompressed WAV).
+    :param search_radius_ms: How far a cut may move to fall in a silence (0 for fixed cuts).
+    :param overlap_ms: How much audio each segment shares with the next one.
+    :return: The list of segments (buffers or file paths) and the segments directory (None in memory).
+    """
+    encoding = encoding or upload_encoding("wav", sample_rate=None, channels=None)
+    margin_ms = search_radius_ms + overlap_ms
+    segment_duration_ms = (
+        fit_segment_duration(trimmed_audio, segment_duration_ms + margin_ms, encoding)
+        - margin_ms
+    )
+    segments_dir = make_segments_dir(output_dir) if to_disk else None
+
+    with metrics.span("segment", segment_duration_ms=segment_duration_ms) as span:
+        if search_radius_ms:
+            cuts = silence_cut_points(
+                trimmed_audio, segment_duration_ms, start_ms, search_radius_ms
+            )
+        else:
+            cuts = list(range(start_ms, len(trimmed_audio), segment_duration_ms))
+            cuts.append(len(trimmed_audio))
+
+        segments = []
+        raw_bytes = encoded_bytes = 0
+        for i, end in zip(cuts, cuts[1:]):
+            segment = trimmed_audio[i : end + overlap_ms]
+            raw_bytes += len(segment.raw_data)
+            segment_name = (
+                f"segment_{(i - start_ms) // 1000:02d}.{encoding['format']}"
+            )
+            stored, size = store_segment(
+                segment, segment_name, encoding, segments_dir, i
+            )
+            encoded_bytes += size
+            segments.append(stored)
+        span["segments"] = len(segments)
+    report_encoding_savings(raw_bytes, encoded_bytes)
     return segments, segments_dir
 
 
+# Function to cap a segment duration to the upload byte budget
+def fit_segment_duration(audio, segment_duration_ms, encoding):
+    budget_ms = max_segment_duration_ms(audio, encoding)
+    if segment_duration_ms > budget_ms:
+        print(
+            f"Segment duration reduced to {budget_ms // 1000}s to fit the upload limit."
+        )
+        return budget_ms
+    return segment_duration_ms
+
+
+# Function to read the duration of an audio file without decoding it
+def probe_duration_ms(filepath):
+    return int(float(mediainfo(filepath).get("duration", 0)) * 1000)
+
+
+# Function to get an empty AudioSegment in the sample format of stream_audio windows
+def stream_reference_audio(encoding):
+    return AudioSegment.silent(duration=0, frame_rate=encoding["sample_rate"] or 16000)
+
+
+# Lines of ffmpeg errors kept to report a failed decode
+FFMPEG_ERROR_LINES = 50
+
+
+# Function to read a process output in a thread, keeping its last lines
+def drain_stream(stream, max_lines=FFMPEG_ERROR_LINES):
+    lines = deque(maxlen=max_lines)
+    thread = threading.Thread(
+        target=lambda: lines.extend(iter(stream.readline, b"")), daemon=True
+    )
+    thread.start()
+    return thread, lines
+
+
+# Function to decode an audio file as a stream of fixed-size windows
+def stream_audio(filepath, window_ms=10000, sample_rate=16000, channels=1):
+    """
+    Decodes an audio file through an ffmpeg pipe, one window at a time.
+
+    Only one window of 16-bit PCM is held in memory, whatever the file length.
+
+    :param filepath: Path to the audio file.
+    :param window_ms: The length of each decoded window in milliseconds.
+    :param sample_rate: The decoding sample rate in Hz.
+    :param channels: The number of decoded channels.
+    :return: Yields AudioSegment windows.
+    """
+    frame_width = 2 * channels
+    window_bytes = int(sample_rate * window_ms / 1000) * frame_width
+    command = [
+        get_encoder_name(),
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-i",
+        str(filepath),
+        "-f",
+        "s16le",
+        "-acodec",
+        "pcm_s16le",
+        "-ac",
+        str(channels),
+        "-ar",
+        str(sample_rate),
+        "-",
+    ]
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    # A noisy input must not block ffmpeg on a full stderr pipe
+    stderr_thread, stderr_lines = drain_stream(process.stderr)
+    try:
+        while True:
+            with metrics.span("decode", file=os.path.basename(filepath)):
+                data = process.stdout.read(window_bytes)
+            if not data:
+                break
+            yield AudioSegment(
+                data=data[: len(data) - len(data) % frame_width],
+                sample_width=2,
+                frame_rate=sample_rate,
+                channels=channels,
+            )
+        if process.wait() != 0:
+            stderr_thread.join()
+            raise RuntimeError(
+                f"ffmpeg failed to decode {filepath}: "
+                f"{b''.join(stderr_lines).decode(errors='replace')}"
+            )
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        stderr_thread.join()
+        process.stdout.close()
+        process.stderr.close()
+
+
+# Function to trim, segment and encode an audio file without decoding it whole
+def stream_segments(
+    filepath,
+    segment_duration_ms,
+    output_dir,
+    trim=True,
+    to_disk=False,
+    encoding=None,
+    window_ms=10000,
+    search_radius_ms=0,
+    overlap_ms=0,
+):
+    """
+    Streaming counterpart of load_audio + segment_audio.
+
+    The file is decoded window by window at the upload sample rate, so peak
+    memory is bounded by window_ms plus one segment instead of the file length.
+
+    :param filepath: Path to the audio file.
+    :param segment_duration_ms: The length of each segment in milliseconds.
+    :param output_dir: The directory receiving the segments folder when to_disk is set.
+    :param trim: Whether to drop the leading silence.
+    :param to_disk: Write the segments as files instead of in-memory buffers.
+    :param encoding: Settings from upload_encoding (defaults to uncompressed 16 kHz mono WAV).
+    :param window_ms: The decoding buffer length in milliseconds.
+    :param search_radius_ms: How far a cut may move to fall in a silence (0 for fixed cuts).
+    :param overlap_ms: How much audio each segment shares with the next one.
+    :return: A generator of segments (buffers or file paths) and the segments directory (None in memory).
+    """
+    encoding = encoding or upload_encoding("wav")
+    segments_dir = make_segments_dir(output_dir) if to_disk else None
+    segments = _stream_segments(
+        filepath,
+        segment_duration_ms,
+        trim,
+        encoding,
+        window_ms,
+        segments_dir,
+        search_radius_ms,
+        overlap_ms,
+    )
+    return segments, segments_dir
+
+
+def _stream_segments(
+    filepath,
+    segment_duration_ms,
+    trim,
+    encoding,
+    window_ms,
+    segments_dir,
+    search_radius_ms,
+    overlap_ms,
+):
+    sample_rate = encoding["sample_rate"] or 16000
+    channels = encoding["channels"] or 1
+    pending = None
+    started = not trim
+    trim_offset_ms = 0
+    position_ms = 0
+    raw_bytes = encoded_bytes = 0
+    budget_checked = False
+
+    def store(segment):
+        segment_name = f"segment_{position_ms // 1000:02d}.{encoding['format']}"
+        return store_segment(
+            segment, segment_name, encoding, segments_dir, trim_offset_ms + position_ms
+        )
+
+    for window in stream_audio(filepath, window_ms, sample_rate, channels):
+        if not budget_checked:
+            margin_ms = search_radius_ms + overlap_ms
+            segment_duration_ms = (
+                fit_segment_duration(window, segment_duration_ms + margin_ms, encoding)
+                - margin_ms
+            )
+            budget_checked = True
+        if not started:
+            with metrics.span("trim"):
+                start_trim = milliseconds_until_sound(window)
+            if start_trim >= len(window):
+                trim_offset_ms += len(window)
+                continue
+            trim_offset_ms += start_trim
+            window = window[start_trim:]
+            started = True
+        pending = window if pending is None else pending + window
+        while (
+            pending is not None
+            and len(pending) >= segment_duration_ms + margin_ms
+        ):
+            with metrics.span("segment", segment_duration_ms=segment_duration_ms):
+                cut = segment_duration_ms
+                if search_radius_ms:
+                    # A cut never moves back by more than half a segment, so a search
+                    # radius larger than that cannot give an empty segment
+                    cut = quietest_point(
+                        frame_dbfs(pending[: cut + search_radius_ms], 50),
+                        max(cut - search_radius_ms, segment_duration_ms // 2),
+                        cut + search_radius_ms,
+                    )
+                segment = pending[: cut + overlap_ms]
+                pending = pending[cut:] or None
+            raw_bytes += len(segment.raw_data)
+            stored, size = store(segment)
+            encoded_bytes += size
+            position_ms += cut
+            yield stored
+
+    if pending is not None:
+        raw_bytes += len(pending.raw_data)
+        stored, size = store(pending)
+        encoded_bytes += size
+        yield stored
+    report_encoding_savings(raw_bytes, encoded_bytes)
+
+
 # Function to clean up a directory
 def cleanup_directory(*dir_paths):
     results = []
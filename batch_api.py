@@ -0,0 +1,214 @@
+import json
+import os
+import time
+
+import cache_utils
+import metrics
+import openai_client
+import rate_limiter
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+
+# Polling of a submitted batch: first interval, growth factor and longest interval
+POLL_SECONDS = 5
+POLL_BACKOFF = 1.5
+MAX_POLL_SECONDS = 300
+
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def chat_request(
+    custom_id, model, input_text, system_prompt, format="text", temperature=0
+):
+    """
+    Builds one line of a Batch API input file: the same request as openai_text.aopenai_completion.
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model,
+            "temperature": float(temperature),
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": input_text},
+            ],
+            "response_format": {"type": format},
+        },
+    }
+
+
+def write_batch_file(requests, name):
+    """
+    Writes the requests to a JSONL file in the cache directory.
+
+    :return: The path of the file.
+    """
+    path = cache_utils.cache_path(f"batch_{name}.jsonl")
+    with open(path, "w", encoding="utf-8") as batch_file:
+        for request in requests:
+            batch_file.write(json.dumps(request, ensure_ascii=False) + "\n")
+    return path
+
+
+def call_with_retries(request):
+    """
+    Calls a files or batches endpoint, retrying rate-limit, server and connection errors.
+    """
+    for attempt in range(rate_limiter.MAX_RETRIES + 1):
+        try:
+            return request()
+        except Exception as e:
+            if attempt == rate_limiter.MAX_RETRIES or not rate_limiter.is_retryable(e):
+                raise
+            time.sleep(rate_limiter.retry_delay(e, attempt))
+
+
+def submit_batch(client, path):
+    """
+    Uploads a Batch API input file and creates the batch.
+
+    :return: The batch object.
+    """
+    metrics.add("bytes_uploaded", os.path.getsize(path), endpoint="files")
+
+    # Each attempt reads the file from the start: a failed upload may have consumed it
+    def upload():
+        with open(path, "rb") as batch_file:
+            return client.files.create(file=batch_file, purpose="batch")
+
+    input_file = call_with_retries(upload)
+    return call_with_retries(
+        lambda: client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=COMPLETION_WINDOW,
+        )
+    )
+
+
+def wait_for_batch(client, batch_id, on_poll=None):
+    """
+    Polls a batch until it reaches a terminal status, backing off between polls.
+
+    :param on_poll: Called after every poll, e.g. to renew the lease of a job.
+    :return: The batch object.
+    """
+    delay = POLL_SECONDS
+    while True:
+        batch = call_with_retries(lambda: client.batches.retrieve(batch_id))
+        if on_poll:
+            on_poll()
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        counts = batch.request_counts
+        if counts is not None:
+            print(
+                f"Batch {batch_id} {batch.status}: "
+                f"{counts.completed}/{counts.total} requests done."
+            )
+        time.sleep(delay)
+        delay = min(delay * POLL_BACKOFF, MAX_POLL_SECONDS)
+
+
+def read_results(client, batch, model):
+    """
+    Downloads the output file of a finished batch.
+
+    :param model: The model the requests were made for, labelling the token counters
+        like the other completions (the response reports a dated snapshot name).
+    :return: A dictionary of the generated texts by custom_id (failed requests are absent).
+    """
+    results = {}
+    if not batch.output_file_id:
+        return results
+    content = call_with_retries(lambda: client.files.content(batch.output_file_id))
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            print(f"Batch request {result['custom_id']} failed: {result.get('error')}")
+            continue
+        body = response["body"]
+        usage = body.get("usage") or {}
+        for kind in ("prompt", "completion"):
+            if usage.get(f"{kind}_tokens") is not None:
+                metrics.add("tokens", usage[f"{kind}_tokens"], model=model, kind=kind)
+        results[result["custom_id"]] = body["choices"][0]["message"]["content"]
+    return results
+
+
+def batch_completion(
+    model: str,
+    input_texts,
+    system_prompt: str,
+    format="text",
+    temperature: float = 0,
+    name="completion",
+    checkpoint=None,
+    batch_id=None,
+    on_submitted=None,
+    on_poll=None,
+    client=None,
+):
+    """
+    Runs one completion per input text through the Batch API and returns them in input order.
+
+    Slower than openai_text.parallel_completion (results can take up to 24 hours)
+    but billed at the Batch API discount, for overnight processing of archives.
+    The base URL of the client follows OPENAI_BASE_URL, so the whole loop can run
+    against a local stand-in server.
+
+    :param input_texts: The user input texts, e.g. the chunks of a transcript.
+    :param name: Names the batch input file in the cache directory.
+    :param checkpoint: Optional job_store.Checkpoint: texts with a saved completion are
+        not submitted, and the completions are saved once the batch is done.
+    :param batch_id: A batch submitted earlier for these texts, to wait for instead of submitting.
+    :param on_submitted: Called as on_submitted(batch_id) once the batch is created.
+    :param on_poll: Called every time the batch status is polled.
+    :return: The list of generated texts (None for failed texts).
+    """
+    client = client or openai_client.get_client()
+    results = [
+        checkpoint.get(index) if checkpoint is not None else None
+        for index in range(len(input_texts))
+    ]
+    missing = [index for index, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+
+    if batch_id is None:
+        path = write_batch_file(
+            [
+                chat_request(
+                    str(index),
+                    model,
+                    input_texts[index],
+                    system_prompt,
+                    format,
+                    temperature,
+                )
+                for index in missing
+            ],
+            name,
+        )
+        batch_id = submit_batch(client, path).id
+        print(f"Batch {batch_id} submitted with {len(missing)} requests.")
+        if on_submitted:
+            on_submitted(batch_id)
+
+    with metrics.span("batch", batch_id=batch_id, requests=len(missing)) as span:
+        batch = wait_for_batch(client, batch_id, on_poll)
+        span["status"] = batch.status
+    if batch.status != "completed":
+        print(f"Batch {batch_id} {batch.status}.")
+    completions = read_results(client, batch, model)
+    for index in missing:
+        results[index] = completions.get(str(index))
+        if checkpoint is not None and results[index] is not None:
+            checkpoint.set(index, results[index])
+    return results
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark of openai_text.create_chunks against the previous quadratic chunker.
+
+Usage: python benchmarks/bench_chunker.py [--words 50000] [--chunk_size 2000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openai_text  # noqa: E402
+
+
+# Previous implementation: decodes up to chunk_size candidate chunks per chunk
+def create_chunks_quadratic(text, chunk_size, tokenizer):
+    tokens = tokenizer.encode(text)
+    i = 0
+    while i < len(tokens):
+        j = min(i + int(1.5 * chunk_size), len(tokens))
+        while j > i + int(0.5 * chunk_size):
+            chunk = tokenizer.decode(tokens[i:j])
+            if chunk.endswith(".") or chunk.endswith("\n"):
+                break
+            j -= 1
+        if j == i + int(0.5 * chunk_size):
+            j = min(i + chunk_size, len(tokens))
+        yield tokens[i:j]
+        i = j
+
+
+# Transcript-like text: long unpunctuated runs with occasional sentence ends
+def synthetic_transcript(words, seed=0):
+    random.seed(seed)
+    vocabulary = ["meeting", "client", "budget", "so", "we", "think", "the", "project"]
+    parts = []
+    for _ in range(words):
+        parts.append(random.choice(vocabulary))
+        if random.random() < 0.002:
+            parts[-1] += random.choice([".", "\n"])
+    return " ".join(parts)
+
+
+def time_chunker(chunker, text, chunk_size, tokenizer):
+    start = time.perf_counter()
+    chunks = list(chunker(text, chunk_size, tokenizer))
+    return time.perf_counter() - start, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunker micro-benchmark")
+    parser.add_argument("--words", type=int, default=50000)
+    parser.add_argument("--chunk_size", type=int, default=2000)
+    parser.add_argument("--tokenizer_name", default="cl100k_base")
+    args = parser.parse_args()
+
+    tokenizer = openai_text.initialize_tokenizer(args.tokenizer_name)
+    text = synthetic_transcript(args.words)
+
+    linear_time, linear_chunks = time_chunker(
+        openai_text.create_chunks, text, args.chunk_size, tokenizer
+    )
+    quadratic_time, quadratic_chunks = time_chunker(
+        create_chunks_quadratic, text, args.chunk_size, tokenizer
+    )
+    assert linear_chunks == quadratic_chunks, "Chunk shapes differ"
+
+    print(f"Tokens: {len(tokenizer.encode(text))}, chunks: {len(linear_chunks)}")
+    print(f"Quadratic chunker: {quadratic_time * 1000:.1f} ms")
+    print(f"Linear chunker:    {linear_time * 1000:.1f} ms")
+    print(f"Speedup: {quadratic_time / linear_time:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
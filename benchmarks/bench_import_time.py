@@ -0,0 +1,93 @@
+"""
+Import-time benchmark of the entry points, to catch startup regressions.
+
+Each module is imported in a fresh interpreter with `python -X importtime`;
+the cumulative time of the module and of its slowest dependencies is reported,
+along with the heavy subsystems it actually loaded.
+
+Usage: python benchmarks/bench_import_time.py [--modules openai_agi GUI_interface]
+       [--runs 5] [--top 10] [--max_ms 150]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Dependencies that should only be loaded by the entry points that need them
+HEAVY_MODULES = ["openai", "numpy", "pydub", "tiktoken", "tkinter", "colorama"]
+
+CHECK_LOADED = (
+    "import importlib.util, sys; "
+    "print(','.join(m for m in {heavy!r} if m in sys.modules "
+    "and not isinstance(sys.modules[m], importlib.util._LazyModule)))"
+)
+
+
+def import_times(module):
+    """
+    Imports a module in a fresh interpreter.
+
+    :return: The cumulative import time per module in microseconds, and the
+        heavy dependencies actually loaded.
+    """
+    code = f"import {module}; " + CHECK_LOADED.format(heavy=HEAVY_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=REPO_DIRECTORY,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if name.strip() == "site":
+            # Interpreter startup, imported before the module
+            times = {}
+            continue
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return times, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time benchmark")
+    parser.add_argument("--modules", nargs="+", default=["openai_agi"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument(
+        "--max_ms",
+        type=float,
+        default=None,
+        help="Exit with an error when a module takes longer than this to import.",
+    )
+    args = parser.parse_args()
+
+    regressions = []
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.runs)]
+        total_ms = statistics.median(times[module] for times, _ in runs) / 1000
+        print(f"{module}: {total_ms:.1f} ms (median of {args.runs} runs)")
+        print(f"  heavy modules loaded: {', '.join(runs[-1][1]) or 'none'}")
+        slowest = sorted(
+            ((time, name) for name, time in runs[-1][0].items() if name != module),
+            reverse=True,
+        )[: args.top]
+        for time, name in slowest:
+            print(f"  {time / 1000:8.1f} ms  {name}")
+        if args.max_ms is not None and total_ms > args.max_ms:
+            regressions.append(module)
+
+    if regressions:
+        sys.exit(f"Import time over {args.max_ms} ms: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+End-to-end benchmark of the pipeline against the local mock OpenAI server.
+
+Synthetic recordings of each duration are run through every stage
+(trim_start, segment_audio, parallel_transcribe_audio, create_chunks,
+clean_transcription) and through the whole openai_agi CLI. Each measurement
+runs in a fresh process with an empty cache directory, so the peak RSS is the
+stage's own and no result comes from a cache. Wall-clock time, throughput
+(seconds of audio per second) and peak RSS are written as JSON; --compare
+prints the change against the JSON of another commit.
+
+Usage: python benchmarks/bench_pipeline.py [--durations 60 600] [--stages ...]
+       [--upload_format ogg] [--output bench_pipeline.json] [--compare old.json]
+       [mock server options, see mock_openai_server.py]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRECTORY)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_openai_server  # noqa: E402
+
+STAGES = [
+    "trim_start",
+    "segment_audio",
+    "parallel_transcribe_audio",
+    "create_chunks",
+    "clean_transcription",
+    "pipeline",
+]
+
+# Answers to the CLI questions: audio description, secretary instructions,
+# save the note, clean up the segments
+PIPELINE_ANSWERS = "\n\nn\nn\n"
+
+
+# Speech-like synthetic recording: leading silence, then tone bursts separated by pauses
+def synthetic_audio(duration_s, sample_rate=44100, channels=2, seed=0):
+    import numpy as np
+    from pydub import AudioSegment
+
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(int(duration_s * sample_rate), dtype=np.float32)
+    position = 2 * sample_rate
+    while position < len(samples):
+        burst = int(rng.uniform(3, 8) * sample_rate)
+        t = np.arange(min(burst, len(samples) - position)) / sample_rate
+        pitch = rng.uniform(100, 300)
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)
+        samples[position : position + len(t)] = (
+            0.3 * envelope * np.sin(2 * np.pi * pitch * t)
+            + 0.02 * rng.standard_normal(len(t))
+        )
+        position += len(t) + int(rng.uniform(0.3, 1.0) * sample_rate)
+    pcm = (samples * 32767).astype(np.int16)
+    pcm = np.repeat(pcm[:, None], channels, axis=1).ravel()
+    return AudioSegment(
+        data=pcm.tobytes(), sample_width=2, frame_rate=sample_rate, channels=channels
+    )
+
+
+# Transcript-like text of the length a recording of this duration would give
+def synthetic_transcript(duration_s, seed=0):
+    import random
+
+    random.seed(seed)
+    words = mock_openai_server.WORDS
+    parts = []
+    for _ in range(int(duration_s * 2.5)):
+        parts.append(random.choice(words))
+        if random.random() < 0.05:
+            parts[-1] += "."
+    return " ".join(parts)
+
+
+def peak_rss_mb(usage):
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss * scale / 1e6
+
+
+def setup_child(work_directory, environment):
+    os.environ.update(environment)
+    os.chdir(work_directory)
+    sys.path.insert(0, REPO_DIRECTORY)
+
+
+def run_stage(stage, audio_path, duration_s, options):
+    """
+    Runs one stage in the current (fresh) process.
+
+    Inputs are prepared outside of the timed section.
+
+    :return: The wall-clock time of the stage and the peak RSS of the process.
+    """
+    import argparse
+    import resource
+
+    import audio_utils
+    import openai_client
+    import openai_text
+
+    encoding = audio_utils.upload_encoding(options["upload_format"])
+    segment_duration_ms = options["segment_duration_sec"] * 1000
+    search_radius_ms = int(options["silence_search_sec"] * 1000)
+
+    if stage == "trim_start":
+        start = time.perf_counter()
+        audio_utils.trim_start(audio_path)
+    elif stage == "segment_audio":
+        audio, start_trim = audio_utils.load_audio(audio_path)
+        start = time.perf_counter()
+        audio_utils.segment_audio(
+            audio,
+            segment_duration_ms,
+            os.getcwd(),
+            start_trim,
+            False,
+            encoding,
+            search_radius_ms,
+        )
+    elif stage == "parallel_transcribe_audio":
+        import openai_audio
+
+        audio, start_trim = audio_utils.load_audio(audio_path)
+        segments, _ = audio_utils.segment_audio(
+            audio,
+            segment_duration_ms,
+            os.getcwd(),
+            start_trim,
+            False,
+            encoding,
+            search_radius_ms,
+        )
+        client = openai_client.get_client()
+        start = time.perf_counter()
+        openai_audio.parallel_transcribe_audio(
+            segments, client, "en", "", "text", use_cache=False
+        )
+    elif stage == "create_chunks":
+        text = synthetic_transcript(duration_s)
+        tokenizer = openai_text.initialize_tokenizer("cl100k_base")
+        start = time.perf_counter()
+        list(openai_text.create_chunks(text, 2000, tokenizer))
+    elif stage == "clean_transcription":
+        import openai_agi
+
+        text = synthetic_transcript(duration_s)
+        prompts = openai_agi.load_prompts(os.path.join(REPO_DIRECTORY, "prompts.json"))
+        args = argparse.Namespace(
+            cleaning=True,
+            tokenizer_name="cl100k_base",
+            cleaning_concurrency=options["cleaning_concurrency"],
+            batch_api=False,
+            file=audio_path,
+            output_directory=os.getcwd(),
+        )
+        openai_text.initialize_tokenizer(args.tokenizer_name)
+        start = time.perf_counter()
+        openai_agi.clean_transcription(text, args, prompts)
+    else:
+        raise ValueError(f"Unknown stage {stage}")
+    wall_seconds = time.perf_counter() - start
+    return wall_seconds, peak_rss_mb(resource.getrusage(resource.RUSAGE_SELF))
+
+
+def run_pipeline(audio_path, work_directory, environment, options):
+    """
+    Runs the openai_agi CLI on a recording, answering its questions.
+
+    :return: The wall-clock time and the peak RSS of the CLI process.
+    """
+    shutil.copy(os.path.join(REPO_DIRECTORY, "prompts.json"), work_directory)
+    command = [
+        sys.executable,
+        os.path.join(REPO_DIRECTORY, "openai_agi.py"),
+        audio_path,
+        "--output_directory",
+        work_directory,
+        "--upload_format",
+        options["upload_format"],
+        "--segment_duration_sec",
+        str(options["segment_duration_sec"]),
+        "--no_cache",
+    ]
+    # stderr goes to a file: a full pipe would block the CLI while wait4 waits for it
+    with tempfile.TemporaryFile() as stderr_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            command,
+            cwd=work_directory,
+            env={**os.environ, **environment},
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr_file,
+        )
+        process.stdin.write(PIPELINE_ANSWERS.encode())
+        process.stdin.close()
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr_file.seek(0)
+            raise RuntimeError(stderr_file.read().decode(errors="replace")[-2000:])
+    return wall_seconds, peak_rss_mb(usage)
+
+
+def measure(stage, audio_path, duration_s, base_url, options):
+    work_directory = tempfile.mkdtemp(prefix=f"bench_{stage}_")
+    environment = {
+        "OPENAI_BASE_URL": base_url,
+        "OPENAI_API_KEY": "mock-key",
+        "OPENAI_ORG": "mock-org",
+        "OPENAI_AGI_CACHE_DIR": os.path.join(work_directory, "cache"),
+    }
+    # Keep the tokenizer files downloaded once, the caches start empty
+    environment["TIKTOKEN_CACHE_DIR"] = os.environ.get(
+        "TIKTOKEN_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bench_tiktoken")
+    )
+    try:
+        if stage == "pipeline":
+            wall_seconds, rss = run_pipeline(
+                audio_path, work_directory, environment, options
+            )
+        else:
+            with ProcessPoolExecutor(
+                1,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=setup_child,
+                initargs=(work_directory, environment),
+            ) as pool:
+                wall_seconds, rss = pool.submit(
+                    run_stage, stage, audio_path, duration_s, options
+                ).result()
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return {
+        "stage": stage,
+        "audio_seconds": duration_s,
+        "wall_seconds": round(wall_seconds, 4),
+        "throughput": round(duration_s / wall_seconds, 2),
+        "peak_rss_mb": round(rss, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIRECTORY,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_path):
+    with open(previous_path, encoding="utf-8") as previous_file:
+        previous = json.load(previous_file)
+    baseline = {
+        (result["stage"], result["audio_seconds"]): result
+        for result in previous["results"]
+    }
+    print(f"\nCompared with {previous.get('commit')} ({previous_path}):")
+    for result in results:
+        old = baseline.get((result["stage"], result["audio_seconds"]))
+        if old is None:
+            continue
+        print(
+            f"  {result['stage']:<26} {result['audio_seconds']:>6}s audio: "
+            f"wall x{result['wall_seconds'] / old['wall_seconds']:.2f}, "
+            f"peak RSS {result['peak_rss_mb'] - old['peak_rss_mb']:+.1f} MB"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline benchmark on a mock server")
+    parser.add_argument("--durations", type=int, nargs="+", default=[60, 600])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--upload_format", choices=["ogg", "mp3", "wav"], default="ogg")
+    parser.add_argument("--segment_duration_sec", type=int, default=60)
+    parser.add_argument("--silence_search_sec", type=float, default=2.0)
+    parser.add_argument("--cleaning_concurrency", type=int, default=8)
+    parser.add_argument("--sample_rate", type=int, default=44100)
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument(
+        "--compare", default=None, help="JSON output of a previous run to compare with."
+    )
+    mock_openai_server.add_config_arguments(parser)
+    args = parser.parse_args()
+
+    options = {
+        "upload_format": args.upload_format,
+        "segment_duration_sec": args.segment_duration_sec,
+        "silence_search_sec": args.silence_search_sec,
+        "cleaning_concurrency": args.cleaning_concurrency,
+    }
+    mock_config = mock_openai_server.config_from_args(args)
+    server = mock_openai_server.start_server(mock_config)
+    audio_directory = tempfile.mkdtemp(prefix="bench_audio_")
+    results = []
+    try:
+        for duration_s in args.durations:
+            audio_path = os.path.join(audio_directory, f"synthetic_{duration_s}s.wav")
+            synthetic_audio(duration_s, args.sample_rate, args.channels).export(
+                audio_path, format="wav"
+            )
+            for stage in args.stages:
+                result = measure(
+                    stage, audio_path, duration_s, server.base_url, options
+                )
+                results.append(result)
+                print(
+                    f"{stage:<26} {duration_s:>6}s audio: "
+                    f"{result['wall_seconds']:8.2f}s, "
+                    f"{result['throughput']:8.1f}x realtime, "
+                    f"peak RSS {result['peak_rss_mb']:7.1f} MB"
+                )
+    finally:
+        server.shutdown()
+        shutil.rmtree(audio_directory, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": options,
+        "mock": {**mock_config, "stats": server.stats},
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
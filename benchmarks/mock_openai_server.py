@@ -0,0 +1,499 @@
+"""
+Local stand-in for the OpenAI endpoints used by the pipeline, for benchmarks.
+
+Serves /v1/audio/transcriptions, /v1/audio/speech and /v1/chat/completions
+(streamed or not), plus /v1/files and /v1/batches for the Batch API path.
+Latency, server errors and 429 responses are injected according to the
+configuration, and x-ratelimit-* headers are sent from a requests-per-minute
+bucket so the client rate limiter behaves as against the real API.
+
+Point the pipeline at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+Usage: python benchmarks/mock_openai_server.py [--port 8089]
+       [--latency lognormal:0.8:0.4] [--latency_per_mb 0.5] [--error_rate 0.01]
+       [--rate_limit_rate 0.02] [--rpm 3000] [--words 120]
+"""
+
+import argparse
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "so the meeting went well and the client agreed on the budget for the next quarter"
+).split()
+
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution: 'fixed:S', 'uniform:MIN:MAX' or 'lognormal:MEDIAN:SIGMA'.
+
+    :return: A function returning a latency in seconds.
+    """
+    kind, *values = spec.split(":")
+    values = [float(value) for value in values]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_multipart(body, content_type):
+    """
+    Splits a multipart/form-data body into {field name: bytes}.
+    """
+    boundary = content_type.split("boundary=")[1].strip('"').encode()
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        headers, value = part.split(b"\r\n\r\n", 1)
+        for header in headers.decode("utf-8", "replace").split("\r\n"):
+            if header.lower().startswith("content-disposition") and ' name="' in header:
+                name = header.split(' name="')[1].split('"')[0]
+                if value.endswith(b"\r\n"):
+                    value = value[: -len(b"\r\n")]
+                fields[name] = value
+    return fields
+
+
+class RequestBucket:
+    """
+    A requests-per-minute bucket producing the x-ratelimit-* headers.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        :return: Whether the request is allowed, and the rate-limit headers.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.capacity / 60,
+            )
+            self.updated = now
+            allowed = self.tokens >= 1
+            if allowed:
+                self.tokens -= 1
+            reset = (1 - self.tokens % 1) * 60 / self.capacity
+            headers = {
+                "x-ratelimit-limit-requests": str(self.capacity),
+                "x-ratelimit-remaining-requests": str(int(self.tokens)),
+                "x-ratelimit-reset-requests": f"{reset:.3f}s",
+            }
+        return allowed, headers
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, MockOpenAIHandler)
+        self.config = config
+        self.latency = parse_latency(config["latency"])
+        self.bucket = RequestBucket(config["rpm"])
+        self.files = {}
+        self.batches = {}
+        self.ids = itertools.count()
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def new_id(self, prefix):
+        return f"{prefix}-{next(self.ids)}"
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = (
+                json.dumps(body) if content_type == "application/json" else body
+            ).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("content-length") or 0))
+
+    def admit(self, upload_bytes=0):
+        """
+        Applies the injected latency, errors and rate limits to a request.
+
+        :return: The rate-limit headers, or None when an error was already sent.
+        """
+        server = self.server
+        config = server.config
+        server.count("requests")
+        allowed, headers = server.bucket.take()
+        if not allowed or random.random() < config["rate_limit_rate"]:
+            server.count("rate_limited")
+            headers["retry-after-ms"] = str(int(config["retry_after_ms"]))
+            self.send(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                headers=headers,
+            )
+            return None
+        time.sleep(server.latency() + config["latency_per_mb"] * upload_bytes / 1e6)
+        if random.random() < config["error_rate"]:
+            server.count("errors")
+            self.send(500, {"error": {"message": "Injected server error"}})
+            return None
+        return headers
+
+    def do_POST(self):
+        body = self.read_body()
+        path = self.path.split("?")[0]
+        if path.endswith("/audio/transcriptions"):
+            return self.transcription(body)
+        if path.endswith("/audio/speech"):
+            return self.speech(body)
+        if path.endswith("/chat/completions"):
+            return self.chat_completion(body)
+        if path.endswith("/files"):
+            return self.upload_file(body)
+        if path.endswith("/batches"):
+            return self.create_batch(body)
+        self.send(404, {"error": {"message": f"Unknown endpoint {path}"}})
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if "/batches/" in path:
+            return self.retrieve_batch(path.rsplit("/", 1)[1])
+        if path.endswith("/content") and "/files/" in path:
+            file_id = path.split("/")[-2]
+            if file_id in self.server.files:
+                return self.send(
+                    200, self.server.files[file_id], "application/octet-stream"
+                )
+        self.send(404, {"error": {"message": f"Unknown endpoint {path}"}})
+
+    def transcription(self, body):
+        fields = parse_multipart(body, self.headers["content-type"])
+        audio = fields.get("file", b"")
+        headers = self.admit(len(audio))
+        if headers is None:
+            return
+        response_format = fields.get("response_format", b"json").decode()
+        words = [random.choice(WORDS) for _ in range(self.server.config["words"])]
+        text = " ".join(words).capitalize() + "."
+        duration = len(words) / 2.5
+        if response_format == "text":
+            return self.send(200, text, "text/plain", headers)
+        if response_format in ("srt", "vtt"):
+            separator = "," if response_format == "srt" else "."
+            minutes, seconds = divmod(int(duration), 60)
+            hours, minutes = divmod(minutes, 60)
+            end = f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}000"
+            cue = f"1\n00:00:00{separator}000 --> {end}\n{text}\n\n"
+            if response_format == "vtt":
+                cue = "WEBVTT\n\n" + cue
+            return self.send(200, cue, "text/plain", headers)
+        transcription = {"text": text}
+        if response_format == "verbose_json":
+            transcription.update(
+                task="transcribe",
+                language="english",
+                duration=duration,
+                segments=[
+                    {"id": 0, "seek": 0, "start": 0.0, "end": duration, "text": text}
+                ],
+            )
+        self.send(200, transcription, headers=headers)
+
+    def speech(self, body):
+        request = json.loads(body)
+        headers = self.admit()
+        if headers is None:
+            return
+        # About one second of 32 kbps audio per 15 characters of input
+        audio = bytes(random.getrandbits(8) for _ in range(len(request["input"]) * 270))
+        self.send(200, audio, "audio/mpeg", headers)
+
+    def completion_text(self, request):
+        if (request.get("response_format") or {}).get("type") == "json_object":
+            return json.dumps(
+                {
+                    "File": "Mock note",
+                    "Front": "---\ntags: [mock]\n---\n",
+                    "Body": "# Summary\n" + " ".join(random.choices(WORDS, k=150)),
+                }
+            )
+        # The cleaning prompt returns the text it was given
+        return request["messages"][-1]["content"]
+
+    @staticmethod
+    def completion_usage(request, content):
+        # About 4 characters per token
+        prompt_tokens = sum(len(m["content"]) // 4 for m in request["messages"])
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+        }
+
+    def chat_completion(self, body):
+        request = json.loads(body)
+        headers = self.admit()
+        if headers is None:
+            return
+        content = self.completion_text(request)
+        usage = self.completion_usage(request, content)
+        completion_id = self.server.new_id("chatcmpl")
+        if request.get("stream"):
+            include_usage = (request.get("stream_options") or {}).get("include_usage")
+            return self.stream_completion(
+                completion_id,
+                request["model"],
+                content,
+                headers,
+                usage if include_usage else None,
+            )
+        self.send(
+            200,
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            },
+            headers=headers,
+        )
+
+    def stream_completion(self, completion_id, model, content, headers, usage=None):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("connection", "close")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.close_connection = True
+        pieces = [content[i : i + 40] for i in range(0, len(content), 40)] + [None]
+        for piece in pieces:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": piece} if piece is not None else {},
+                        "finish_reason": None if piece is not None else "stop",
+                    }
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        if usage is not None:
+            # Sent last, with no choices, like the API with include_usage
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def upload_file(self, body):
+        fields = parse_multipart(body, self.headers["content-type"])
+        file_id = self.server.new_id("file")
+        self.server.files[file_id] = fields.get("file", b"")
+        self.send(
+            200,
+            {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(self.server.files[file_id]),
+                "created_at": int(time.time()),
+                "filename": "batch.jsonl",
+                "purpose": fields.get("purpose", b"").decode(),
+                "status": "processed",
+            },
+        )
+
+    def create_batch(self, body):
+        request = json.loads(body)
+        lines = self.server.files[request["input_file_id"]].decode("utf-8").splitlines()
+        results = []
+        for line in filter(str.strip, lines):
+            batch_request = json.loads(line)
+            content = self.completion_text(batch_request["body"])
+            results.append(
+                {
+                    "id": self.server.new_id("batch_req"),
+                    "custom_id": batch_request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "model": batch_request["body"]["model"],
+                            "usage": self.completion_usage(
+                                batch_request["body"], content
+                            ),
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": content,
+                                    },
+                                }
+                            ]
+                        },
+                    },
+                    "error": None,
+                }
+            )
+        output_file_id = self.server.new_id("file")
+        self.server.files[output_file_id] = "\n".join(
+            json.dumps(result) for result in results
+        ).encode("utf-8")
+        batch_id = self.server.new_id("batch")
+        self.server.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request["completion_window"],
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": output_file_id,
+            "request_counts": {"total": len(results), "completed": 0, "failed": 0},
+        }
+        self.send(200, self.server.batches[batch_id])
+
+    def retrieve_batch(self, batch_id):
+        batch = self.server.batches.get(batch_id)
+        if batch is None:
+            return self.send(404, {"error": {"message": f"No batch {batch_id}"}})
+        # Completes on the second poll, exercising the polling loop
+        if batch["status"] == "in_progress" and batch.get("polled"):
+            batch["status"] = "completed"
+            counts = batch["request_counts"]
+            counts["completed"] = counts["total"]
+        batch["polled"] = True
+        self.send(200, {k: v for k, v in batch.items() if k != "polled"})
+
+
+def default_config():
+    return {
+        "latency": "lognormal:0.8:0.4",
+        "latency_per_mb": 0.5,
+        "error_rate": 0.0,
+        "rate_limit_rate": 0.0,
+        "retry_after_ms": 500,
+        "rpm": 3000,
+        "words": 120,
+    }
+
+
+def start_server(config=None, host="127.0.0.1", port=0):
+    """
+    Starts the mock server in a daemon thread.
+
+    :param config: Overrides of default_config().
+    :return: The running server; its base_url goes in OPENAI_BASE_URL.
+    """
+    server = MockOpenAIServer((host, port), {**default_config(), **(config or {})})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_config_arguments(parser):
+    defaults = default_config()
+    parser.add_argument(
+        "--latency",
+        default=defaults["latency"],
+        help="Latency distribution: fixed:S, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA.",
+    )
+    parser.add_argument(
+        "--latency_per_mb",
+        type=float,
+        default=defaults["latency_per_mb"],
+        help="Extra seconds of latency per uploaded MB.",
+    )
+    parser.add_argument("--error_rate", type=float, default=defaults["error_rate"])
+    parser.add_argument(
+        "--rate_limit_rate",
+        type=float,
+        default=defaults["rate_limit_rate"],
+        help="Share of requests answered with an injected 429.",
+    )
+    parser.add_argument(
+        "--retry_after_ms", type=float, default=defaults["retry_after_ms"]
+    )
+    parser.add_argument("--rpm", type=int, default=defaults["rpm"])
+    parser.add_argument(
+        "--words",
+        type=int,
+        default=defaults["words"],
+        help="Words per transcribed segment.",
+    )
+
+
+def config_from_args(args):
+    return {key: getattr(args, key) for key in default_config()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_server(config_from_args(args), args.host, args.port)
+    print(f"Mock OpenAI server on {server.base_url}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"Stats: {server.stats}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
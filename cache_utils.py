@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+CACHE_DIRECTORY = Path(
+    os.getenv("OPENAI_AGI_CACHE_DIR", Path.home() / ".cache" / "openai_agi")
+)
+
+
+def cache_path(filename):
+    """
+    Returns the path of a cache file, creating the cache directory if needed.
+    """
+    CACHE_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    return CACHE_DIRECTORY / filename
+
+
+def make_key(*parts):
+    """
+    Builds a cache key by hashing the JSON representation of the given parts.
+    """
+    return hashlib.sha256(
+        json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class SQLiteCache:
+    """
+    A persistent key-value cache stored in a SQLite file.
+
+    Entries are evicted least recently used first once the stored values exceed
+    max_bytes, and are ignored (then deleted) once older than ttl_seconds.
+    Values are any JSON-serializable object. Safe to share between threads.
+    """
+
+    def __init__(self, path, max_bytes=200 * 1024 * 1024, ttl_seconds=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(path), check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+        )
+
+    def get(self, key):
+        """
+        Returns the cached value of a key, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """
+        Stores a value and evicts the least recently used entries beyond max_bytes.
+        """
+        now = time.time()
+        value = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now),
+            )
+            self._evict()
+
+    def _evict(self):
+        self._connection.execute(
+            "DELETE FROM entries WHERE key IN ("
+            " SELECT key FROM ("
+            "  SELECT key, SUM(size) OVER ("
+            "   ORDER BY accessed DESC ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW"
+            "  ) AS total FROM entries"
+            " ) WHERE total > ?)",
+            (self.max_bytes,),
+        )
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            entries, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM entries")
+
+
+class MemoryLRU:
+    """
+    A small in-process least recently used cache holding at most max_entries values.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class TieredCache:
+    """
+    An in-process MemoryLRU in front of a persistent SQLiteCache.
+
+    Hot entries are served from memory; disk hits are promoted to memory.
+    """
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+        self.memory_hits = 0
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+        value = self.disk.get(key)
+        if value is not None:
+            self.memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        self.disk.set(key, value)
+
+    def stats(self):
+        stats = self.disk.stats()
+        stats["memory_hits"] = self.memory_hits
+        return stats
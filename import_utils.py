@@ -0,0 +1,43 @@
+import importlib.util
+import sys
+import threading
+
+_load_lock = threading.Lock()
+
+
+def lazy_import(name):
+    """
+    Returns a module that is only executed on its first attribute access.
+
+    Lets an entry point import every subsystem at the top while only paying,
+    at run time, for the ones it actually uses (e.g. no openai, numpy or pydub
+    for a plain --help).
+
+    :param name: The absolute name of the module.
+    :return: The module, already loaded if it was imported before.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load(*modules):
+    """
+    Executes lazily imported modules now.
+
+    The lazy loader is not thread-safe before Python 3.12: a module first used by
+    several threads at once can be seen half-executed by all but one of them.
+    Load the modules used by a thread pool before starting it.
+
+    :param modules: Modules returned by lazy_import (loaded modules are left as is).
+    """
+    with _load_lock:
+        for module in modules:
+            # Any attribute access runs the module
+            getattr(module, "__name__")
@@ -0,0 +1,312 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import cache_utils
+
+JOB_STORE_FILE = "jobs.sqlite"
+
+# A claimed job is given back to the queue when its worker has not renewed its
+# lease for this long (crashed or killed worker)
+LEASE_SECONDS = 300
+
+
+class IncompleteJobError(Exception):
+    """
+    Some units of a job have no result: the job cannot be finished as done.
+    """
+
+
+def worker_id():
+    """
+    Identifies this worker process in the job store.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def worker_alive(owner):
+    """
+    Tells whether the worker holding a lease may still be running.
+
+    Only a process of this host can be checked; the lease of a worker on
+    another host is trusted until it expires.
+    """
+    host, _, pid = (owner or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Checkpoint:
+    """
+    The results of one stage of a job, by unit index (segment, chunk...).
+    """
+
+    def __init__(self, store, job_id, stage):
+        self.store = store
+        self.job_id = job_id
+        self.stage = stage
+
+    def get(self, index):
+        return self.store.get_result(self.job_id, self.stage, index)
+
+    def set(self, index, value):
+        self.store.set_result(self.job_id, self.stage, index, value)
+
+    def missing(self, count):
+        """
+        :return: The indices below count that have no saved result.
+        """
+        return [index for index in range(count) if self.get(index) is None]
+
+
+class Job:
+    """
+    A job claimed by this worker: the processing of one audio file.
+    """
+
+    def __init__(self, store, job_id, file):
+        self.store = store
+        self.id = job_id
+        self.file = file
+
+    def result(self, stage, index=0):
+        return self.store.get_result(self.id, stage, index)
+
+    def save(self, stage, value, index=0):
+        self.store.set_result(self.id, stage, index, value)
+
+    def checkpoint(self, stage):
+        return Checkpoint(self.store, self.id, stage)
+
+    def renew(self):
+        self.store.renew_leases([self.id])
+
+    def finish(self, status="done"):
+        self.store.finish_job(self.id, status)
+
+    def release(self):
+        self.store.release_job(self.id)
+
+
+class JobStore:
+    """
+    A persistent queue of jobs and of their results, stored in a SQLite file.
+
+    Every unit of work (segment transcription, cleaned chunk, note...) is saved
+    as soon as it completes, so an interrupted job resumes where it stopped.
+    Several worker processes can drain the same queue: a job is claimed in an
+    immediate transaction and leased to one worker. The lease is renewed each
+    time the worker saves a result, and by a background thread for as long as
+    the worker holds the job, so a long request does not let it expire.
+    """
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = worker_id()
+        self._lock = threading.Lock()
+        self._held = set()
+        self._renewer = None
+        self._connection = sqlite3.connect(
+            str(path), check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, key TEXT, file TEXT, params TEXT, status TEXT,"
+            " owner TEXT, lease_until REAL, created REAL, updated REAL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "job_id INTEGER, stage TEXT, idx INTEGER, value TEXT, created REAL,"
+            " PRIMARY KEY (job_id, stage, idx))"
+        )
+
+    def create_job(self, file, params, resume=False):
+        """
+        Queues the processing of a file.
+
+        :param params: The settings the results depend on (language, format, models...).
+        :param resume: Reuse the last job of the same file and settings instead of
+            starting from scratch; a failed or abandoned (its worker died) job is
+            queued again, a done job is kept done. Without resume, a new job is
+            queued unless the last one is being run by another live worker, so
+            concurrent workers do not process the file twice.
+        :return: The job id.
+        """
+        stat = os.stat(file)
+        key = cache_utils.make_key(
+            os.path.abspath(file), stat.st_size, stat.st_mtime, params
+        )
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT id, status, owner, lease_until FROM jobs WHERE key = ?"
+                    " ORDER BY id DESC LIMIT 1",
+                    (key,),
+                ).fetchone()
+                leased = (
+                    row is not None
+                    and row[1] == "running"
+                    and row[3] is not None
+                    and row[3] >= now
+                    and worker_alive(row[2])
+                )
+                if not resume and not leased:
+                    row = None
+                if row is None:
+                    job_id = self._connection.execute(
+                        "INSERT INTO jobs (key, file, params, status, created, updated)"
+                        " VALUES (?, ?, ?, 'pending', ?, ?)",
+                        (key, file, json.dumps(params), now, now),
+                    ).lastrowid
+                else:
+                    job_id = row[0]
+                    if row[1] == "failed" or (row[1] == "running" and not leased):
+                        self._connection.execute(
+                            "UPDATE jobs SET status = 'pending', owner = NULL,"
+                            " lease_until = NULL, updated = ? WHERE id = ?",
+                            (now, job_id),
+                        )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def claim_job(self, job_ids):
+        """
+        Leases the next available job among job_ids to this worker.
+
+        A job is available when pending, or running under an expired lease.
+
+        :return: The claimed Job, or None when every job is done or taken.
+        """
+        now = time.time()
+        placeholders = ",".join("?" * len(job_ids))
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    f"SELECT id, file FROM jobs WHERE id IN ({placeholders})"
+                    " AND (status = 'pending' OR (status = 'running' AND lease_until < ?))"
+                    " ORDER BY id LIMIT 1",
+                    (*job_ids, now),
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE jobs SET status = 'running', owner = ?, lease_until = ?,"
+                        " updated = ? WHERE id = ?",
+                        (self.owner, now + self.lease_seconds, now, row[0]),
+                    )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            self._held.add(row[0])
+            if self._renewer is None:
+                self._renewer = threading.Thread(
+                    target=self._renew_held_leases, name="job-leases", daemon=True
+                )
+                self._renewer.start()
+        return Job(self, row[0], row[1])
+
+    def renew_leases(self, job_ids):
+        """
+        Extends the leases this worker holds on the given jobs.
+        """
+        now = time.time()
+        placeholders = ",".join("?" * len(job_ids))
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET lease_until = ?, updated = ?"
+                f" WHERE id IN ({placeholders}) AND owner = ? AND status = 'running'",
+                (now + self.lease_seconds, now, *job_ids, self.owner),
+            )
+
+    def _renew_held_leases(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._lock:
+                held = list(self._held)
+            if held:
+                self.renew_leases(held)
+
+    def job_status(self, job_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT status FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def finish_job(self, job_id, status="done"):
+        self._set_status(job_id, status)
+
+    def release_job(self, job_id):
+        """
+        Gives an unfinished job back to the queue, e.g. when interrupted.
+        """
+        self._set_status(job_id, "pending")
+
+    def _set_status(self, job_id, status):
+        with self._lock:
+            self._held.discard(job_id)
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, lease_until = NULL,"
+                " updated = ? WHERE id = ?",
+                (status, time.time(), job_id),
+            )
+
+    def get_result(self, job_id, stage, index=0):
+        """
+        Returns the saved result of a unit of work, or None if not done yet.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM results WHERE job_id = ? AND stage = ? AND idx = ?",
+                (job_id, stage, index),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_result(self, job_id, stage, index, value):
+        """
+        Saves the result of a unit of work and renews the lease of its job.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (job_id, stage, index, json.dumps(value, ensure_ascii=False), now),
+            )
+            self._connection.execute(
+                "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND owner = ?",
+                (now + self.lease_seconds, now, job_id, self.owner),
+            )
+
+
+_job_store = None
+
+
+# Function returning the persistent job store, opened on first use
+def get_job_store():
+    global _job_store
+    if _job_store is None:
+        _job_store = JobStore(cache_utils.cache_path(JOB_STORE_FILE))
+    return _job_store
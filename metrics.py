@@ -0,0 +1,231 @@
+import contextvars
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Prefix of the exported Prometheus metric names
+PROMETHEUS_PREFIX = "openai_agi"
+
+_current_trace = contextvars.ContextVar("metrics_trace", default=None)
+_current_span = contextvars.ContextVar("metrics_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Registry:
+    """
+    Process-wide totals of the counters and span durations, for the Prometheus export.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, counter, amount, labels):
+        key = (counter, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            count, total = self.spans.get(name, (0, 0.0))
+            self.spans[name] = (count + 1, total + seconds)
+
+
+_registry = Registry()
+
+
+class Trace:
+    """
+    The spans and counters of one job.
+
+    Spans are recorded by every thread and coroutine running in the context of
+    the trace: the context follows the coroutines submitted to the shared event
+    loop (see async_utils), but not the work handed to thread or process pools,
+    which run their own trace and merge it back.
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.wall_seconds = None
+        self.error = None
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def add(self, counter, amount, labels):
+        key = (counter, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def merge(self, exported):
+        """
+        Adds the spans and counters of a trace exported by another process (see to_dict).
+
+        Span starts are shifted to this trace's clock, so work done before the
+        trace began (e.g. in a batch worker process) has a negative start.
+        """
+        shift = exported["started_at"] - self.started_at
+        for span in exported["spans"]:
+            span = {**span, "start": round(span["start"] + shift, 6)}
+            self.record(span)
+            _registry.observe(span["name"], span["seconds"])
+        for counter in exported["counters"]:
+            labels = dict(counter["labels"])
+            self.add(counter["name"], counter["value"], labels)
+            _registry.add(counter["name"], counter["value"], labels)
+
+    def summary(self):
+        """
+        :return: The total seconds and count of the spans of each name.
+        """
+        stages = {}
+        for span in self.spans:
+            stage = stages.setdefault(span["name"], {"count": 0, "seconds": 0.0})
+            stage["count"] += 1
+            stage["seconds"] = round(stage["seconds"] + span["seconds"], 6)
+        return stages
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "attributes": self.attributes,
+                "started_at": self.started_at,
+                "wall_seconds": self.wall_seconds,
+                "error": self.error,
+                "summary": self.summary(),
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "spans": sorted(self.spans, key=lambda span: span["start"]),
+            }
+
+
+@contextmanager
+def trace(name, **attributes):
+    """
+    Collects the spans and counters recorded in this context into a new Trace.
+
+    :return: The Trace, its wall_seconds (and error, if one escaped) set on exit.
+    """
+    current = Trace(name, **attributes)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.wall_seconds = round(time.perf_counter() - current.started, 6)
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times a block of work as a span of the current trace.
+
+    Spans nest: a span opened inside another records it as its parent. The
+    yielded attributes can be completed inside the block (e.g. cached=True).
+    """
+    span_id = f"{os.getpid()}:{next(_span_ids)}"
+    token = _current_span.set(span_id)
+    current = _current_trace.get()
+    started = time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        _current_span.reset(token)
+        _registry.observe(name, seconds)
+        if current is not None:
+            record = {
+                "id": span_id,
+                "parent": _current_span.get(),
+                "name": name,
+                "start": round(started - current.started, 6),
+                "seconds": round(seconds, 6),
+                "thread": threading.current_thread().name,
+                "attributes": attributes,
+            }
+            if error:
+                record["error"] = error
+            current.record(record)
+
+
+def add(counter, amount=1, **labels):
+    """
+    Increments a counter (requests, retries, bytes_uploaded, tokens...) of the current trace.
+
+    Labels given as None are left out.
+    """
+    labels = {name: value for name, value in labels.items() if value is not None}
+    _registry.add(counter, amount, labels)
+    current = _current_trace.get()
+    if current is not None:
+        current.add(counter, amount, labels)
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def prometheus_text(registry=None):
+    """
+    Renders the process-wide totals in the Prometheus text exposition format.
+    """
+    registry = registry or _registry
+    with registry._lock:
+        counters = sorted(registry.counters.items())
+        spans = sorted(registry.spans.items())
+    lines = []
+    declared = set()
+    for (counter, labels), value in counters:
+        metric = f"{PROMETHEUS_PREFIX}_{counter}_total"
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric}{prometheus_labels(labels)} {value}")
+    if spans:
+        metric = f"{PROMETHEUS_PREFIX}_span_seconds"
+        lines.append(f"# TYPE {metric} summary")
+        for name, (count, total) in spans:
+            labels = prometheus_labels([("span", name)])
+            lines.append(f"{metric}_sum{labels} {total:.6f}")
+            lines.append(f"{metric}_count{labels} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    """
+    Writes the process-wide totals to a Prometheus text file.
+
+    The file is replaced atomically, so a node_exporter textfile collector never
+    reads it half-written.
+    """
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as prometheus_file:
+        prometheus_file.write(prometheus_text())
+    os.replace(temporary_path, path)
+
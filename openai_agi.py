@@ -1,19 +1,30 @@
 import argparse
+import concurrent.futures
+import glob
 import json
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from tkinter import messagebox
 
-from colorama import Fore, Style, init
 from dotenv import dotenv_values, load_dotenv
 
-import audio_utils
-import openai_audio
-import openai_text
+import import_utils
+import metrics
 import output_utils
+import transcript_utils
+from import_utils import lazy_import
+
+# Subsystems loaded on first use: a --help or a TTS-only run skips the audio,
+# tokenizer and batch dependencies
+audio_utils = lazy_import("audio_utils")
+batch_api = lazy_import("batch_api")
+colorama = lazy_import("colorama")
+job_store = lazy_import("job_store")
+openai_audio = lazy_import("openai_audio")
+openai_text = lazy_import("openai_text")
+planner = lazy_import("planner")
 
-# Initialize colorama
-init(autoreset=True)
 # Print text in different colors
 # print(f"{Fore.RED}This is red text")
 # print(f"{Fore.GREEN}This is green text")
@@ -76,11 +87,15 @@ def check_env_variables(mode="cli", parent=None):
         if mode == "cli":
             print("All required environment variables are set.")
         else:
+            from tkinter import messagebox
+
             messagebox.showinfo("Info", "All required environment variables are set.")
         return all_vars_set
     if mode == "cli":
         print("Not all environment variables are set correctly.")
     else:
+        from tkinter import messagebox
+
         messagebox.showerror(
             "Error", "Not all environment variables are set correctly."
         )
@@ -96,7 +111,12 @@ def create_parser():
 
 def setup_parser(parser):
     # Argument for specifying an audio file
-    parser.add_argument("file", help="Path to the audio file", nargs="?", default=None)
+    parser.add_argument(
+        "file",
+        help="Path to the audio file, or a directory or glob pattern to process a batch of files",
+        nargs="?",
+        default=None,
+    )
 
     # Argument for specifying an output directory.
     parser.add_argument(
@@ -178,7 +198,7 @@ def setup_parser(parser):
         "--no_trim",
         "-nt",
         dest="trim",
-        help="Prevent trimming the silence at the start of the file, recommended for srt output.",
+        help="Prevent trimming the silence at the start of the file.",
         action="store_false",
         default=True,
     )
@@ -188,9 +208,60 @@ def setup_parser(parser):
         "--segment_duration_sec",
         "-sds",
         dest="segment_duration_sec",
-        help="Specify the leght of audio segment duration in seconds,\
-        defaults to 60 seconds.",
-        default=60,
+        help="Specify the leght of audio segment duration in seconds. By default it is\
+        planned from the recording length and the available concurrency.\
+        Capped to fit the 25 MB upload limit once encoded.",
+        type=int,
+        default=None,
+    )
+
+    # Option for audio pre-processing: align segment cuts on silences.
+    parser.add_argument(
+        "--silence_search_sec",
+        "-sss",
+        dest="silence_search_sec",
+        help="Move each segment cut to the quietest point within this many seconds\
+        of its target, 0 for fixed-length cuts. Default to 2.",
+        type=float,
+        default=2.0,
+    )
+
+    # Option for audio pre-processing: overlap between segments.
+    parser.add_argument(
+        "--overlap_sec",
+        "-ov",
+        dest="overlap_sec",
+        help="Audio shared by consecutive segments, in seconds. The words transcribed\
+        twice are removed at the seams, which allows short (10-20 s) segments. Default to 0.",
+        type=float,
+        default=0.0,
+    )
+
+    # Options for audio pre-processing: upload encoding.
+    parser.add_argument(
+        "--upload_format",
+        "-uf",
+        dest="upload_format",
+        choices=["ogg", "mp3", "wav"],
+        help="Codec used to upload the segments (mono, resampled). Default to ogg (Opus).",
+        default="ogg",
+    )
+
+    parser.add_argument(
+        "--upload_bitrate",
+        "-ub",
+        dest="upload_bitrate",
+        help="Bitrate of the uploaded segments, Ex: 24k. Default to the codec's bitrate.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--upload_sample_rate",
+        "-usr",
+        dest="upload_sample_rate",
+        help="Sample rate of the uploaded segments in Hz. Default to 16000.",
+        type=int,
+        default=16000,
     )
 
     # Option for audio pre-processing: segmentation.
@@ -203,6 +274,134 @@ def setup_parser(parser):
         default=True,
     )
 
+    # Option for audio pre-processing: keep the segments on disk.
+    parser.add_argument(
+        "--keep_segments",
+        "-ks",
+        dest="keep_segments",
+        help="Write the audio segments to disk, in the --upload_format encoding,\
+        instead of keeping them in memory.",
+        action="store_true",
+        default=False,
+    )
+
+    # Option for audio pre-processing: streaming decode for long recordings.
+    parser.add_argument(
+        "--stream",
+        "-st",
+        dest="stream",
+        help="Decode, trim and segment the audio file window by window through ffmpeg,\
+        keeping memory bounded for very long recordings.",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--stream_window_sec",
+        "-sws",
+        dest="stream_window_sec",
+        help="Length of the streaming decode buffer in seconds. Default to 10.",
+        type=int,
+        default=10,
+    )
+
+    # Option for transcription: reuse results of segments already transcribed.
+    parser.add_argument(
+        "--no_cache",
+        "-nca",
+        dest="cache",
+        help="Prevent reading and writing the transcription cache.",
+        action="store_false",
+        default=True,
+    )
+
+    # Option for transcription post-processing: cleaning concurrency.
+    parser.add_argument(
+        "--cleaning_concurrency",
+        "-cc",
+        dest="cleaning_concurrency",
+        help="Maximum number of transcript chunks cleaned at the same time. Default to 8.",
+        type=int,
+        default=8,
+    )
+
+    # Option for the job store: resume interrupted jobs.
+    parser.add_argument(
+        "--resume",
+        "-r",
+        dest="resume",
+        help="Resume the last job of the same file and settings: only the segments,\
+        chunks and stages without a saved result are run again.",
+        action="store_true",
+        default=False,
+    )
+
+    # Option for transcription post-processing: Batch API submission.
+    parser.add_argument(
+        "--batch_api",
+        "-ba",
+        dest="batch_api",
+        help="Send the cleaning and secretary note requests through the Batch API:\
+        cheaper, but results can take up to 24 hours. Use with --resume to pick up\
+        a batch after an interruption.",
+        action="store_true",
+        default=False,
+    )
+
+    # Option for cost control: budget of a job.
+    parser.add_argument(
+        "--budget",
+        "-bu",
+        dest="budget",
+        help="Maximum cost of a job in dollars. Over budget, the note is written with\
+        gpt-3.5-turbo, then the cleaning is skipped, then the job is refused.\
+        The estimate is printed before transcription either way.",
+        type=float,
+        default=None,
+    )
+
+    # Options for observability: job traces and metrics export.
+    parser.add_argument(
+        "--trace",
+        "-tr",
+        dest="trace",
+        help="Write a JSON trace of each job to the output directory: the timing\
+        spans of every stage and request, and the request, retry, upload and token\
+        counters.",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--prometheus_file",
+        "-pf",
+        dest="prometheus_file",
+        help="Write the request, retry, upload, token and stage timing totals to this\
+        file in the Prometheus text format (e.g. for a node_exporter textfile collector).",
+        default=None,
+    )
+
+    # Options for batch mode: worker pools.
+    parser.add_argument(
+        "--cpu_workers",
+        "-cw",
+        dest="cpu_workers",
+        help="Processes decoding, trimming, segmenting and encoding files in batch mode.\
+        Default to the number of CPUs.",
+        type=int,
+        default=os.cpu_count(),
+    )
+
+    parser.add_argument(
+        "--io_workers",
+        "-iw",
+        dest="io_workers",
+        help="Files transcribed, cleaned and summarized at the same time in batch mode.\
+        Default to 4.",
+        type=int,
+        default=4,
+    )
+
     # Option for transcription post-processing: punctuation and formating cleaning.
     parser.add_argument(
         "--no_cleaning",
@@ -224,7 +423,17 @@ def load_prompts(prompts_file_path):
 def parse_arguments():
     parser = create_parser()
     setup_parser(parser)
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.silence_search_sec < 0:
+        parser.error("--silence_search_sec must not be negative.")
+    if (
+        args.segment_duration_sec is not None
+        and 2 * args.silence_search_sec >= args.segment_duration_sec
+    ):
+        parser.error(
+            "--silence_search_sec must be less than half of --segment_duration_sec."
+        )
+    return args
 
 
 def load_environment_variables():
@@ -247,7 +456,224 @@ def setup_output_directory(args):
     return args.output_directory
 
 
-def process_audio(client, prompts, args):
+def print_segment_progress(index, transcription):
+    if transcription is None:
+        print(f"{colorama.Fore.RED}Segment {index} failed.")
+    else:
+        print(f"{colorama.Fore.GREEN}Segment {index} transcribed.")
+
+
+def plan_segments(args, duration_ms, audio, encoding):
+    """
+    Returns the segmentation plan: the planner's choice, or the requested segment duration.
+
+    A --silence_search_sec too long for the planned segments (half of them or
+    more) is shortened.
+    """
+    if args.segment_duration_sec is not None:
+        return {
+            "duration_ms": duration_ms,
+            "segment_duration_ms": args.segment_duration_sec * 1000,
+            "workers": None,
+        }
+    plan = planner.plan_segmentation(
+        duration_ms, audio, encoding, int(args.overlap_sec * 1000)
+    )
+    planner.report_plan(plan)
+    max_search_sec = plan["segment_duration_ms"] / 1000 / 4
+    if 2 * args.silence_search_sec * 1000 >= plan["segment_duration_ms"]:
+        print(
+            f"{colorama.Fore.YELLOW}--silence_search_sec {args.silence_search_sec} is"
+            f" too long for {plan['segment_duration_ms'] / 1000:.0f}s segments,"
+            f" using {max_search_sec:g}."
+        )
+        args.silence_search_sec = max_search_sec
+    return plan
+
+
+def upload_encoding(args):
+    return audio_utils.upload_encoding(
+        args.upload_format, args.upload_bitrate, args.upload_sample_rate
+    )
+
+
+def prepare_audio(args):
+    """
+    Decodes, trims, segments and encodes args.file (the CPU-bound stages).
+
+    Without --stream the segments are materialized, so this can run in a worker
+    process of the batch mode and hand its result back to the parent.
+
+    :return: The segmentation plan, the segments and their directory (None in memory).
+    """
+    encoding = upload_encoding(args)
+    overlap_ms = int(args.overlap_sec * 1000)
+    if args.stream:
+        # Decoding, trimming and encoding happen as the segments are transcribed
+        plan = plan_segments(
+            args,
+            audio_utils.probe_duration_ms(args.file),
+            audio_utils.stream_reference_audio(encoding),
+            encoding,
+        )
+        segments, segments_dir = audio_utils.stream_segments(
+            args.file,
+            plan["segment_duration_ms"],
+            os.path.dirname(args.output_directory),
+            args.trim,
+            args.keep_segments,
+            encoding,
+            args.stream_window_sec * 1000,
+            int(args.silence_search_sec * 1000),
+            overlap_ms,
+        )
+    else:
+        with metrics.span("prepare", file=os.path.basename(args.file)):
+            audio, start_trim = audio_utils.load_audio(args.file, args.trim)
+            plan = plan_segments(args, len(audio) - start_trim, audio, encoding)
+            segments, segments_dir = audio_utils.segment_audio(
+                audio,
+                plan["segment_duration_ms"],
+                os.path.dirname(args.output_directory),
+                start_trim,
+                args.keep_segments,
+                encoding,
+                int(args.silence_search_sec * 1000),
+                overlap_ms,
+            )
+    return plan, segments, segments_dir
+
+
+def transcribe_segments(client, args, plan, segments, audio_prompt, job=None):
+    """
+    Transcribes the segments of args.file and saves the transcript (the network stage).
+
+    With a job, each segment transcription is saved in the job store as it arrives,
+    and the transcript only once every segment has one.
+
+    :return: The plain text of the transcript.
+    """
+    filetype = transcript_utils.FORMAT_FILETYPES[args.format]
+    segment_count = 0
+
+    # Segments may be streamed, they are only counted once all are produced
+    def count_segments():
+        nonlocal segment_count
+        for segment in segments:
+            segment_count += 1
+            yield segment
+
+    with metrics.span("transcribe"), output_utils.open_output_file(
+        args.file, args.output_directory, filetype
+    ) as partial_transcript:
+        transcription = openai_audio.parallel_transcribe_audio(
+            count_segments(),
+            client,
+            args.language,
+            audio_prompt,
+            args.format,
+            max_workers=plan["workers"],
+            output_file=partial_transcript,
+            progress_callback=print_segment_progress,
+            use_cache=args.cache,
+            overlap_ms=int(args.overlap_sec * 1000),
+            tokenizer=(
+                openai_text.initialize_tokenizer(args.tokenizer_name)
+                if args.overlap_sec
+                else None
+            ),
+            checkpoint=job.checkpoint("segment") if job else None,
+        )
+    output_utils.save_to_file(transcription, args.file, args.output_directory, filetype)
+    transcription = transcript_utils.transcript_text(transcription, args.format)
+    if job:
+        check_complete(job, "segment", segment_count)
+        job.save("transcript", transcription)
+    return transcription
+
+
+def check_complete(job, stage, count):
+    """
+    Raises job_store.IncompleteJobError when some units of a stage have no result.
+
+    The job is then failed instead of done, and --resume only retries the
+    missing units.
+    """
+    missing = job.checkpoint(stage).missing(count)
+    if missing:
+        raise job_store.IncompleteJobError(
+            f"{job.file}: {stage}s {missing} have no result."
+        )
+
+
+def job_params(args):
+    """
+    The settings a job's results depend on: a change starts a new job on --resume.
+    """
+    return {
+        setting: getattr(args, setting)
+        for setting in (
+            "language",
+            "format",
+            "model",
+            "temperature",
+            "tokenizer_name",
+            "trim",
+            "segment_duration_sec",
+            "silence_search_sec",
+            "overlap_sec",
+            "upload_format",
+            "upload_bitrate",
+            "upload_sample_rate",
+            "cleaning",
+        )
+    }
+
+
+def ask_once(job, stage, question):
+    """
+    Asks a question, or returns the answer saved by the job before an interruption.
+    """
+    answer = job.result(stage) if job else None
+    if answer is None:
+        answer = input(question)
+        if job:
+            job.save(stage, answer)
+    return answer
+
+
+def check_budget(args, prompts, plan, transcription=None):
+    """
+    Prints the cost and time estimate of the job, downgrading args to fit --budget.
+
+    :raises planner.BudgetExceededError: When the job cannot fit the budget.
+    """
+    tokenizer = openai_text.initialize_tokenizer(args.tokenizer_name)
+    prompt_tokens = {
+        "cleaning": len(tokenizer.encode(prompts["Punctuation assistant"])),
+        "note": len(tokenizer.encode(prompts["Personal assistant"])),
+    }
+    settings = {
+        "overlap_ms": int(args.overlap_sec * 1000),
+        "cleaning": args.cleaning,
+        "cleaning_concurrency": args.cleaning_concurrency,
+        "model": args.model,
+        "batch_api": args.batch_api,
+    }
+    settings, estimate = planner.fit_budget(
+        plan,
+        settings,
+        prompt_tokens,
+        args.budget,
+        len(tokenizer.encode(transcription)) if transcription is not None else None,
+    )
+    planner.report_estimate(estimate, args.batch_api)
+    args.model = settings["model"]
+    args.cleaning = settings["cleaning"]
+    return estimate
+
+
+def process_audio(client, prompts, args, job=None):
     if args:
         if args.file is None:
             openai_audio.create_audio(
@@ -255,42 +681,101 @@ def process_audio(client, prompts, args):
             )
             exit()
 
-        audio_prompt = input("\aDescribe the audio file (optional):\n-> ")
-        audio_file_path = args.file
-        trimmed_audio, _ = audio_utils.trim_start(audio_file_path)
-        segments, segments_dir = audio_utils.segment_audio(
-            trimmed_audio,
-            args.segment_duration_sec * 1000,
-            os.path.dirname(args.output_directory),
+        audio_prompt = ask_once(
+            job, "audio_prompt", "\aDescribe the audio file (optional):\n-> "
         )
+        transcription = job.result("transcript") if job else None
+        if transcription is not None:
+            print(f"{colorama.Fore.GREEN}Transcript restored from the job store.")
+            plan = job.result("plan")
+            if plan is not None:
+                check_budget(args, prompts, plan, transcription)
+            return transcription, audio_prompt, None
+        plan, segments, segments_dir = prepare_audio(args)
+        check_budget(args, prompts, plan)
+        if job:
+            job.save("plan", plan)
 
         print("Audio file segmented.\nTranscribing..............")
         print(
-            f"{Fore.BLUE}Segments: {segments}\nclient: {client}\nlanguage: {args.language}\naudio prompt: {audio_prompt}\nformat: {args.format}"
+            f"{colorama.Fore.BLUE}client: {client}\nlanguage: {args.language}\naudio prompt: {audio_prompt}\nformat: {args.format}"
         )
-        transcription = openai_audio.parallel_transcribe_audio(
-            segments, client, args.language, audio_prompt, args.format
+        transcription = transcribe_segments(
+            client, args, plan, segments, audio_prompt, job
         )
-        output_utils.save_to_file(transcription, args.file, args.output_directory)
+        # The transcript gives the real token counts of the completion stages
+        check_budget(args, prompts, plan, transcription)
         return transcription, audio_prompt, segments_dir
 
 
-def clean_transcription(transcription, args, prompts):
+def print_chunk_progress(index, latency):
+    print(f"{colorama.Fore.GREEN}Chunk {index} cleaned in {latency:.1f}s.")
+
+
+def submit_to_batch_api(job, stage, model, input_texts, system_prompt, **options):
+    """
+    Runs completions through the Batch API, saving them as the given stage of the job.
+
+    The batch id is saved with the job, so --resume waits for a submitted batch
+    instead of paying for it twice.
+    """
+    if job is None:
+        return batch_api.batch_completion(model, input_texts, system_prompt, **options)
+    if "name" in options:
+        # Files of a batch can share a stem, their input files must not
+        options["name"] = f"{options['name']}_{job.id}"
+    completions = batch_api.batch_completion(
+        model,
+        input_texts,
+        system_prompt,
+        checkpoint=job.checkpoint(stage),
+        batch_id=job.result(f"{stage}_batch"),
+        on_submitted=lambda batch_id: job.save(f"{stage}_batch", batch_id),
+        # Results can take hours: keep the job leased to this worker meanwhile
+        on_poll=job.renew,
+        **options,
+    )
+    # The batch is over: a later --resume submits the failed requests again
+    job.save(f"{stage}_batch", None)
+    return completions
+
+
+def clean_transcription(transcription, args, prompts, job=None):
     if not args.cleaning:
         return transcription
 
-    tokenizer = openai_text.initialize_tokenizer(args.tokenizer_name)
-    clean_transcriptions = []
-    chunks = openai_text.create_chunks(transcription, 2000, tokenizer)
-    cleaning_prompt = prompts["Punctuation assistant"]
-
-    for chunk in chunks:
-        clean_transcription = openai_text.openai_completion(
-            "gpt-3.5-turbo",
-            tokenizer.decode(chunk),
-            cleaning_prompt,
-        )
-        clean_transcriptions.append(clean_transcription)
+    with metrics.span("clean", batch_api=args.batch_api) as span:
+        tokenizer = openai_text.initialize_tokenizer(args.tokenizer_name)
+        chunks = [
+            tokenizer.decode(chunk)
+            for chunk in openai_text.create_chunks(transcription, 2000, tokenizer)
+        ]
+        span["chunks"] = len(chunks)
+        cleaning_prompt = prompts["Punctuation assistant"]
+
+        if args.batch_api:
+            clean_transcriptions = submit_to_batch_api(
+                job,
+                "chunk",
+                "gpt-3.5-turbo",
+                chunks,
+                cleaning_prompt,
+                name=f"clean_{Path(args.file).stem}",
+            )
+        else:
+            clean_transcriptions = openai_text.parallel_completion(
+                "gpt-3.5-turbo",
+                chunks,
+                cleaning_prompt,
+                max_concurrency=args.cleaning_concurrency,
+                progress_callback=print_chunk_progress,
+                checkpoint=job.checkpoint("chunk") if job else None,
+            )
+    # Keep the raw text of chunks that could not be cleaned
+    clean_transcriptions = [
+        clean_chunk if clean_chunk is not None else chunk
+        for chunk, clean_chunk in zip(chunks, clean_transcriptions)
+    ]
 
     cleaned_transcription = "\n".join(clean_transcriptions)
     output_utils.save_to_file(
@@ -298,44 +783,406 @@ def clean_transcription(transcription, args, prompts):
         f"clean_{os.path.basename(args.file)}",
         args.output_directory,
     )
+    if job:
+        check_complete(job, "chunk", len(chunks))
     return cleaned_transcription
 
 
-def create_secretary_note(args, cleaned_transcription, transcription, prompts):
-    secretary_prompt = prompts["Personal assistant"] + input(
-        "\aSecretary instructions : \n-> "
+def create_secretary_note(
+    args,
+    cleaned_transcription,
+    transcription,
+    prompts,
+    instructions=None,
+    echo=True,
+    job=None,
+):
+    secretary_note = job.result("note") if job else None
+    if secretary_note is not None:
+        return output_utils.json_to_obsidian(secretary_note)
+    if instructions is None:
+        instructions = ask_once(job, "instructions", "\aSecretary instructions : \n-> ")
+    secretary_prompt = prompts["Personal assistant"] + instructions
+    if args.batch_api:
+        # The note is saved by the batch checkpoint
+        with metrics.span("note", model=args.model, batch_api=True):
+            (secretary_note,) = submit_to_batch_api(
+                job,
+                "note",
+                args.model,
+                [cleaned_transcription or transcription],
+                secretary_prompt,
+                format="json_object",
+                temperature=args.temperature,
+                name=f"note_{Path(args.file).stem}",
+            )
+        if secretary_note is None:
+            raise RuntimeError("The secretary note request of the batch failed.")
+        return output_utils.json_to_obsidian(secretary_note)
+    deltas = []
+    with metrics.span("note", model=args.model, batch_api=False):
+        for delta in openai_text.stream_completion(
+            args.model,
+            cleaned_transcription or transcription,
+            secretary_prompt,
+            "json_object",
+            args.temperature,
+        ):
+            if echo:
+                print(delta, end="", flush=True)
+            deltas.append(delta)
+    if echo:
+        print()
+    # The JSON note can only be parsed once the stream is complete
+    secretary_note = "".join(deltas)
+    note = output_utils.json_to_obsidian(secretary_note)
+    if job:
+        job.save("note", secretary_note)
+    return note
+
+
+AUDIO_EXTENSIONS = {
+    ".aac",
+    ".flac",
+    ".m4a",
+    ".mp3",
+    ".mp4",
+    ".mpeg",
+    ".mpga",
+    ".ogg",
+    ".opus",
+    ".wav",
+    ".webm",
+}
+
+
+def is_batch(path):
+    return path is not None and (os.path.isdir(path) or glob.has_magic(path))
+
+
+# Function returning the directory the files of a batch are found under
+def batch_root(pattern):
+    if os.path.isdir(pattern):
+        return pattern
+    parts = []
+    for part in Path(pattern).parts:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.path.join(*parts) if parts else "."
+
+
+# Function mirroring the place of a batch file under its root in the output directory
+def batch_output_directory(args, root, path):
+    """
+    Files of a batch can share a name (a/x.mp3 and b/x.mp3): their outputs go to
+    the subdirectories of their relative path, so they do not overwrite each other.
+    """
+    relative_directory = os.path.relpath(os.path.dirname(path), root)
+    return os.path.normpath(os.path.join(args.output_directory, relative_directory))
+
+
+def find_audio_files(pattern):
+    """
+    Lists the audio files of a directory, or the files matching a glob pattern.
+    """
+    if os.path.isdir(pattern):
+        return sorted(
+            str(path)
+            for path in Path(pattern).iterdir()
+            if path.suffix.lower() in AUDIO_EXTENSIONS
+        )
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def timed_prepare_audio(args):
+    # Runs in a worker process: its spans are handed back to the job's trace
+    with metrics.trace("prepare", file=args.file) as trace:
+        plan, segments, segments_dir = prepare_audio(args)
+    return plan, segments, segments_dir, trace.wall_seconds, trace.to_dict()
+
+
+def save_trace(args, trace):
+    """
+    Writes the JSON trace of a job to the output directory when --trace is set.
+
+    The file is named after the job id too, so the runs of a file do not overwrite
+    each other's trace.
+    """
+    if args.trace and trace is not None:
+        output_utils.save_to_file(
+            trace.to_dict(),
+            # save_to_file drops the extension: the stem is kept whole even with dots
+            f"trace_{trace.attributes['job_id']}_{os.path.basename(args.file)}",
+            args.output_directory,
+            "json",
+        )
+
+
+def save_prometheus(args):
+    if args.prometheus_file:
+        metrics.write_prometheus(args.prometheus_file)
+
+
+def process_prepared_file(
+    client, prompts, args, job, prepared, audio_prompt, secretary_instructions
+):
+    """
+    Runs the network stages of one file of a batch: transcription, cleaning and note.
+
+    :param prepared: The result of timed_prepare_audio, or None when the job
+        already has its transcript.
+    :return: The per-file summary: audio duration, segment count and stage timings.
+    """
+    trace = None
+    try:
+        with metrics.trace("job", file=args.file, job_id=job.id) as trace:
+            return run_file_stages(
+                client,
+                prompts,
+                args,
+                job,
+                prepared,
+                audio_prompt,
+                secretary_instructions,
+                trace,
+            )
+    finally:
+        save_trace(args, trace)
+
+
+def run_file_stages(
+    client, prompts, args, job, prepared, audio_prompt, secretary_instructions, trace
+):
+    started = time.perf_counter()
+    if prepared is None:
+        plan = job.result("plan")
+        transcription = job.result("transcript")
+        prepare_seconds = 0.0
+    else:
+        plan, segments, segments_dir, prepare_seconds, prepare_trace = prepared
+        # The decoding, trimming and encoding spans of the worker process
+        trace.merge(prepare_trace)
+        plan = {**plan, "segments": len(segments)}
+        job.save("plan", plan)
+        check_budget(args, prompts, plan)
+        transcription = transcribe_segments(
+            client, args, plan, segments, audio_prompt, job
+        )
+    check_budget(args, prompts, plan, transcription)
+    summary = {
+        "file": args.file,
+        "audio_seconds": plan["duration_ms"] / 1000,
+        "segments": plan.get("segments", 0),
+        "prepare": prepare_seconds,
+        "transcribe": time.perf_counter() - started,
+    }
+
+    started = time.perf_counter()
+    cleaned_transcription = clean_transcription(transcription, args, prompts, job)
+    summary["clean"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    (
+        secretary_note_file,
+        secretary_note_front,
+        secretary_note_body,
+    ) = create_secretary_note(
+        args,
+        cleaned_transcription,
+        transcription,
+        prompts,
+        secretary_instructions,
+        echo=False,
+        job=job,
     )
-    secretary_note = openai_text.openai_completion(
-        args.model,
-        cleaned_transcription or transcription,
-        secretary_prompt,
-        "json_object",
-        args.temperature,
+    output_utils.save_to_file(
+        str(secretary_note_front + secretary_note_body),
+        secretary_note_file,
+        args.output_directory,
+        "md",
     )
-    return output_utils.json_to_obsidian(secretary_note)
+    summary["note"] = time.perf_counter() - started
+    return summary
 
 
-def main():
-    args = parse_arguments()
-    print("parsed args")
-    openai_api_key, openai_org = load_environment_variables()
-    print("set env")
-    client = initialize_openai_client(openai_api_key, openai_org)
-    print("set client")
-    setup_output_directory(args)
-    print("set output dir process to prompts loading")
-    prompts = load_prompts("prompts.json")
-    print("Loaded prompts process to transcription")
-    transcription, audio_prompt, segments_dir = process_audio(client, prompts, args)
+def print_file_summary(summary):
+    total = sum(summary[stage] for stage in ("prepare", "transcribe", "clean", "note"))
+    print(
+        f"{colorama.Fore.CYAN}{summary['file']}: "
+        f"{summary['audio_seconds'] / 60:.1f} min of audio in {summary['segments']} segments, "
+        f"prepare {summary['prepare']:.1f}s, transcribe {summary['transcribe']:.1f}s, "
+        f"clean {summary['clean']:.1f}s, note {summary['note']:.1f}s "
+        f"({summary['audio_seconds'] / max(total, 1e-9):.1f}x realtime)"
+    )
+
+
+def print_batch_summary(summaries, failed, wall_seconds):
+    audio_seconds = sum(summary["audio_seconds"] for summary in summaries)
+    print(
+        f"{colorama.Fore.CYAN}Batch done: {len(summaries)} files processed, {len(failed)} failed, "
+        f"{audio_seconds / 60:.1f} min of audio in {wall_seconds:.1f}s "
+        f"({audio_seconds / max(wall_seconds, 1e-9):.1f}x realtime, "
+        f"{len(summaries) / max(wall_seconds, 1e-9) * 3600:.0f} files/hour)"
+    )
+    for path in failed:
+        print(f"{colorama.Fore.RED}Failed: {path}")
+
+
+def run_batch(client, prompts, args):
+    """
+    Processes every audio file of a directory or glob pattern.
+
+    Each file is queued as a job in the job store, then claimed: several
+    processes run on the same files share the work, and --resume picks up the
+    jobs of an interrupted batch. Decoding, trimming, segmenting and encoding
+    run in a pool of cpu_workers processes; transcription, cleaning and the
+    secretary note run in a pool of io_workers threads. A file moves to the I/O
+    pool as soon as it is segmented, so CPU work on the next files overlaps with
+    requests for the previous ones. At most cpu_workers + io_workers files are
+    in flight, bounding memory. The audio description and secretary
+    instructions are asked once for the whole batch, and notes are saved
+    without confirmation. The outputs of a file found in a subdirectory of the
+    batch go to the same subdirectory of the output directory.
+    """
+    files = find_audio_files(args.file)
+    root = batch_root(args.file)
+    if not files:
+        print(f"{colorama.Fore.RED}No audio files found for {args.file}.")
+        return
+    store = job_store.get_job_store()
+    job_ids = [store.create_job(path, job_params(args), args.resume) for path in files]
+    print(f"{len(files)} files to process.")
+    audio_prompt = input("\aDescribe the audio files (optional):\n-> ")
+    secretary_instructions = input("\aSecretary instructions : \n-> ")
+    # Segments are handed over between processes, so they must be materialized
+    args.stream = False
+
+    started = time.perf_counter()
+    pending = {}
+    summaries = []
+    failed = []
+    max_in_flight = args.cpu_workers + args.io_workers
+    # The I/O threads would otherwise race to load the lazily imported subsystems
+    import_utils.load(audio_utils, batch_api, openai_audio, openai_text, planner)
+    import multiprocessing
+
+    # Attribute access: concurrent.futures only loads its process module when used.
+    # Workers are spawned: forking would copy the tokenizer, event loop and lease
+    # threads' locks in whatever state they are in
+    cpu_pool = concurrent.futures.ProcessPoolExecutor(
+        args.cpu_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    io_pool = ThreadPoolExecutor(args.io_workers)
+    running = []
+
+    def process(job, file_args, prepared=None):
+        # A file may have waited for a thread: start it with a fresh lease
+        job.renew()
+        future = io_pool.submit(
+            process_prepared_file,
+            client,
+            prompts,
+            file_args,
+            job,
+            prepared,
+            audio_prompt,
+            secretary_instructions,
+        )
+        pending[future] = ("process", job, file_args)
+
+    def run_batch_loop():
+        while True:
+            while len(pending) < max_in_flight:
+                job = store.claim_job(job_ids)
+                if job is None:
+                    break
+                file_args = argparse.Namespace(
+                    **{
+                        **vars(args),
+                        "file": job.file,
+                        "output_directory": batch_output_directory(
+                            args, root, job.file
+                        ),
+                    }
+                )
+                if job.result("transcript") is not None:
+                    print(f"{job.file}: transcript restored from the job store.")
+                    process(job, file_args)
+                    continue
+                future = cpu_pool.submit(timed_prepare_audio, file_args)
+                pending[future] = ("prepare", job, file_args)
+            if not pending:
+                break
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, job, file_args = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"{colorama.Fore.RED}{file_args.file} failed during {stage}: {e}")
+                    job.finish("failed")
+                    failed.append(file_args.file)
+                    continue
+                if stage == "prepare":
+                    print(f"{file_args.file} segmented, transcribing.")
+                    process(job, file_args, result)
+                else:
+                    job.finish()
+                    print_file_summary(result)
+                    summaries.append(result)
+            save_prometheus(args)
+
+    try:
+        with cpu_pool, io_pool:
+            try:
+                run_batch_loop()
+            except BaseException:
+                # Interrupted: the files not started yet go back to the queue for
+                # --resume or other workers; the running ones keep their lease until
+                # they end, so nobody pays for their requests twice
+                for future, (stage, job, file_args) in pending.items():
+                    if future.cancel():
+                        job.release()
+                    else:
+                        running.append((future, stage, job))
+                if running:
+                    print(
+                        f"{colorama.Fore.YELLOW}Waiting for the {len(running)} files in"
+                        " progress to finish."
+                    )
+                raise
+    except BaseException:
+        for future, stage, job in running:
+            if not future.done():
+                # Interrupted again: the lease lapses with this process
+                continue
+            if future.exception() is not None:
+                job.finish("failed")
+            elif stage == "process":
+                job.finish()
+            else:
+                job.release()
+        raise
+    print_batch_summary(summaries, failed, time.perf_counter() - started)
+    return summaries
+
+
+def run_job(client, prompts, args, job):
+    transcription, audio_prompt, segments_dir = process_audio(
+        client, prompts, args, job
+    )
     print("transcription done")
     print(transcription)
-    cleaned_transcription = clean_transcription(transcription, args, prompts)
+    cleaned_transcription = clean_transcription(transcription, args, prompts, job)
     print("transcription cleaning done\n going to secretary note")
     (
         secretary_note_file,
         secretary_note_front,
         secretary_note_body,
-    ) = create_secretary_note(args, cleaned_transcription, transcription, prompts)
+    ) = create_secretary_note(
+        args, cleaned_transcription, transcription, prompts, job=job
+    )
     print("secretary note done. going to save")
     if input(
         "\nDo you want to save this note as an obsidian.md note? \n-> "
@@ -347,8 +1194,63 @@ def main():
             "md",
         )
     print("saved, …cleaning")
+    return segments_dir
+
+
+def main():
+    args = parse_arguments()
+    colorama.init(autoreset=True)
+    print("parsed args")
+    openai_api_key, openai_org = load_environment_variables()
+    print("set env")
+    client = initialize_openai_client(openai_api_key, openai_org)
+    print("set client")
+    setup_output_directory(args)
+    print("set output dir process to prompts loading")
+    prompts = load_prompts("prompts.json")
+    print("Loaded prompts process to transcription")
+    if args.file is None:
+        process_audio(client, prompts, args)
+    # Threads start from here (tokenizer, event loop, pools): load the lazily
+    # imported subsystems they use first
+    import_utils.load(audio_utils, job_store, openai_audio, openai_text, planner)
+    if args.batch_api:
+        import_utils.load(batch_api)
+    # Loads the BPE ranks in the background while the audio is decoded
+    openai_text.prewarm_tokenizer(args.tokenizer_name)
+    if is_batch(args.file):
+        run_batch(client, prompts, args)
+        return
+    store = job_store.get_job_store()
+    job = store.claim_job([store.create_job(args.file, job_params(args), args.resume)])
+    if job is None:
+        print(
+            f"{colorama.Fore.YELLOW}{args.file} is already done or being processed"
+            " by another worker."
+        )
+        return
+    trace = None
+    try:
+        with metrics.trace("job", file=args.file, job_id=job.id) as trace:
+            segments_dir = run_job(client, prompts, args, job)
+    except planner.BudgetExceededError as e:
+        print(f"{colorama.Fore.RED}{e} Job refused.")
+        job.finish("failed")
+        return
+    except job_store.IncompleteJobError as e:
+        print(f"{colorama.Fore.RED}{e} Run again with --resume to retry them.")
+        job.finish("failed")
+        return
+    except BaseException:
+        # Interrupted or failed: keep the saved results for --resume
+        job.release()
+        raise
+    finally:
+        save_trace(args, trace)
+        save_prometheus(args)
+    job.finish()
 
-    if input("\nShould we clean up the audio segments?\n-> ").lower() in [
+    if segments_dir and input("\nShould we clean up the audio segments?\n-> ").lower() in [
         "y",
         "yes",
         "ok",
@@ -358,7 +1260,7 @@ def main():
         "aller",
     ]:
         audio_utils.cleanup_directory(segments_dir)
-    print(f"Cleaning {segments_dir}")
+        print(f"Cleaning {segments_dir}")
 
 
 if __name__ == "__main__":
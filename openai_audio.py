@@ -1,104 +1,353 @@
-import os
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import time
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+from contextlib import nullcontext
 from pathlib import Path
 
-import openai
-from dotenv import load_dotenv
-from openai import OpenAI
+import async_utils
+import cache_utils
+import metrics
+import openai_client
+import rate_limiter
+import transcript_utils
+from import_utils import lazy_import
 
-# Load environment variables
-load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_ORG = os.getenv("OPENAI_ORG")
-openai.api_key = OPENAI_API_KEY
-
-# client = OpenAI(
-#     organization=OPENAI_ORG,
-# )
+# Only loaded for transcriptions, speech synthesis does not need the audio stack
+planner = lazy_import("planner")
 
 
 # Initialize OpenAI client
 def init_openai_client(api_key, organization):
-    openai.api_key = api_key
-    return openai.OpenAI(organization=organization)
+    return openai_client.get_client(api_key, organization)
 
 
-# Function for transcribing audio
-def transcribe_audio(file_path, client, language, prompt, response_format):
-    try:
-        with open(file_path, "rb") as audio_file:
-            transcription_data = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language=language,
-                prompt=prompt,
-                response_format=response_format,
+# Function to open a segment given either as a file path or an in-memory file
+def open_audio_file(file_path):
+    if hasattr(file_path, "read"):
+        file_path.seek(0)
+        return nullcontext(file_path)
+    return open(file_path, "rb")
+
+
+# Function to measure the bytes uploaded for a segment
+def upload_size(file_path):
+    if hasattr(file_path, "getbuffer"):
+        return file_path.getbuffer().nbytes
+    return Path(file_path).stat().st_size
+
+
+# Maximum size of the on-disk transcription cache
+TRANSCRIPTION_CACHE_BYTES = 200 * 1024 * 1024
+
+_transcription_cache = None
+
+
+# Function returning the persistent transcription cache, opened on first use
+def get_transcription_cache():
+    global _transcription_cache
+    if _transcription_cache is None:
+        _transcription_cache = cache_utils.SQLiteCache(
+            cache_utils.cache_path("transcriptions.sqlite"), TRANSCRIPTION_CACHE_BYTES
+        )
+    return _transcription_cache
+
+
+# Function hashing the audio of a segment
+def audio_digest(file_path):
+    # Segments from audio_utils.store_segment carry a digest of their samples,
+    # stable across runs; other files are hashed as uploaded
+    if getattr(file_path, "audio_digest", None):
+        return file_path.audio_digest
+    digest = hashlib.sha256()
+    with open_audio_file(file_path) as audio_file:
+        for block in iter(lambda: audio_file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Function building the cache key of a transcription request
+def transcription_cache_key(file_path, model, language, prompt, response_format):
+    return cache_utils.make_key(
+        audio_digest(file_path), model, language, prompt, response_format
+    )
+
+
+# Coroutine for transcribing audio
+async def atranscribe_audio(
+    file_path, client, language, prompt, response_format, use_cache=True
+):
+    """
+    Transcribes one segment with an AsyncOpenAI client.
+
+    The request goes through the shared rate limiter, which retries rate-limit
+    and server errors, so an exception here means the segment really failed.
+    Results are cached on disk by audio hash and request parameters, so the same
+    segment is never paid for twice.
+
+    :param use_cache: Look up and store the result in the transcription cache.
+    :return: The transcription data: a string, or a dictionary for the json formats.
+    """
+    model = "whisper-1"
+    with metrics.span(
+        "transcription",
+        segment=Path(getattr(file_path, "name", file_path)).name,
+        offset_ms=getattr(file_path, "offset_ms", None),
+    ) as span:
+        if use_cache:
+            cache = get_transcription_cache()
+            # Hashing and SQLite block, keep them off the event loop
+            cache_key = await asyncio.to_thread(
+                transcription_cache_key,
+                file_path,
+                model,
+                language,
+                prompt,
+                response_format,
             )
-            return transcription_data
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None
+            transcription_data = await asyncio.to_thread(cache.get, cache_key)
+            span["cached"] = transcription_data is not None
+            if transcription_data is not None:
+                return transcription_data
+
+        async def request():
+            metrics.add(
+                "bytes_uploaded",
+                upload_size(file_path),
+                endpoint="audio.transcriptions",
+            )
+            with open_audio_file(file_path) as audio_file:
+                started = time.monotonic()
+                response = await client.audio.transcriptions.with_raw_response.create(
+                    model=model,
+                    file=audio_file,
+                    language=language,
+                    prompt=prompt,
+                    response_format=response_format,
+                )
+            planner.record_transcription_latency(
+                getattr(file_path, "duration_ms", None), time.monotonic() - started
+            )
+            return response
 
+        limiter = rate_limiter.get_limiter("audio.transcriptions", model)
+        transcription_data = await limiter.call(request)
+        if not isinstance(transcription_data, str):
+            transcription_data = transcription_data.model_dump()
+        if use_cache:
+            await asyncio.to_thread(cache.set, cache_key, transcription_data)
+        return transcription_data
 
-# Function for generating voice from text
-def create_audio(
+
+# Function for transcribing audio
+def transcribe_audio(
+    file_path, client, language, prompt, response_format, use_cache=True
+):
+    return async_utils.run_sync(
+        atranscribe_audio(
+            file_path,
+            openai_client.async_client_for(client),
+            language,
+            prompt,
+            response_format,
+            use_cache,
+        )
+    )
+
+
+# Coroutine for generating voice from text
+async def acreate_audio(
     input_text,
     output_directory="speech_file_path",
     speed=1.0,
     voice="onyx",
     model="tts-1-hd",
     response_format="mp3",
+    client=None,
 ):
     speech_file_path = Path(output_directory) / "speech.mp3"
-    try:
-        response = openai.audio.speech.create(
+    client = client or openai_client.get_async_client()
+
+    async def request():
+        return await client.audio.speech.with_raw_response.create(
             model=model,
             voice=voice,
             speed=speed,
             response_format=response_format,
             input=input_text,
         )
-        response.stream_to_file(speech_file_path)
+
+    try:
+        response = await rate_limiter.get_limiter("audio.speech", model).call(request)
+        response.write_to_file(speech_file_path)
         return True
     except Exception as e:
         print(f"An error occurred: {e}")
         return False
 
 
-# Function for parallel audio transcription
-def parallel_transcribe_audio(
+# Function for generating voice from text
+def create_audio(
+    input_text,
+    output_directory="speech_file_path",
+    speed=1.0,
+    voice="onyx",
+    model="tts-1-hd",
+    response_format="mp3",
+):
+    return async_utils.run_sync(
+        acreate_audio(
+            input_text, output_directory, speed, voice, model, response_format
+        )
+    )
+
+
+# Function to yield transcriptions in segment order as soon as they are ready
+def iter_transcriptions(
     file_paths,
     client,
     language,
     prompt,
     response_format,
-    max_workers=10,
+    max_workers=None,
+    progress_callback=None,
+    use_cache=True,
+    checkpoint=None,
 ):
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Create a list of futures with their corresponding index
-        futures = {
-            executor.submit(
-                transcribe_audio, file_path, client, language, prompt, response_format
-            ): i
-            for i, file_path in enumerate(file_paths)
-        }
-
-    # Collect the transcription data as they complete, with their corresponding index
-    transcriptions = {}
-    for future in futures:
+    """
+    Transcribes segments concurrently and yields them in order as they complete.
+
+    A transcription is yielded as soon as it and every segment before it are done,
+    so the first minutes of text are available while later segments are in flight.
+    file_paths may be a generator (e.g. from audio_utils.stream_segments): segments
+    are submitted as they are produced. Requests run on the shared event loop
+    under the 'audio.transcriptions' rate limiter.
+
+    :param file_paths: Segments as file paths or in-memory files.
+    :param max_workers: Optional cap on the segments in flight for this call, by
+        default the concurrency of the endpoint. It also bounds how far a generator
+        of segments is read ahead, and so the encoded audio held in memory.
+    :param progress_callback: Called as progress_callback(index, transcription) when any segment finishes.
+    :param use_cache: Reuse transcriptions of segments already seen (see atranscribe_audio).
+    :param checkpoint: Optional job_store.Checkpoint: segments with a saved result are
+        not sent again, and each new result is saved as soon as it arrives.
+    :return: Yields (index, transcription) tuples, transcription being None on failure.
+    """
+    async_client = openai_client.async_client_for(client)
+    max_workers = max_workers or async_utils.ENDPOINT_CONCURRENCY["audio.transcriptions"]
+    pending = {}
+    results = {}
+    next_index = 0
+
+    def collect(future):
+        index = pending.pop(future)
         try:
-            transcription_data = future.result()  # Get the result from the future
-            index = futures[future]  # Get the index of the future
-            transcriptions[index] = transcription_data
+            results[index] = future.result()
         except Exception as e:
             print(f"An error occurred: {e}")
+            results[index] = None
+        if checkpoint is not None and results[index] is not None:
+            checkpoint.set(index, results[index])
+        if progress_callback:
+            progress_callback(index, results[index])
 
-    # Sort transcriptions by index and combine into a single transcript
-    sorted_transcription_texts = [
-        transcriptions[i]
-        for i in sorted(transcriptions)
-        if transcriptions[i] is not None
-    ]
-    full_transcript = " ".join(sorted_transcription_texts)
+    def ready():
+        nonlocal next_index
+        while next_index in results:
+            yield next_index, results.pop(next_index)
+            next_index += 1
+
+    for i, file_path in enumerate(file_paths):
+        saved = checkpoint.get(i) if checkpoint is not None else None
+        if saved is not None:
+            results[i] = saved
+            yield from ready()
+            continue
+        if len(pending) >= max_workers:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for done_future in done:
+                collect(done_future)
+        future = async_utils.submit(
+            atranscribe_audio(
+                file_path, async_client, language, prompt, response_format, use_cache
+            )
+        )
+        pending[future] = i
+        for done_future in [f for f in pending if f.done()]:
+            collect(done_future)
+        yield from ready()
+
+    for future in as_completed(list(pending)):
+        collect(future)
+        yield from ready()
+
+
+# Function for parallel audio transcription
+def parallel_transcribe_audio(
+    file_paths,
+    client,
+    language,
+    prompt,
+    response_format,
+    max_workers=None,
+    output_file=None,
+    progress_callback=None,
+    use_cache=True,
+    overlap_ms=0,
+    tokenizer=None,
+    checkpoint=None,
+):
+    """
+    Transcribes segments in parallel and combines them into a single transcript.
+
+    Segment results are merged by transcript_utils.TranscriptMerger: srt, vtt and
+    verbose_json timestamps are shifted by each segment's offset_ms (its position
+    in the recording, trim included) and subtitle cues are renumbered.
+
+    :param output_file: Optional open text file receiving the transcript incrementally.
+    :param progress_callback: Called as progress_callback(index, transcription) per segment.
+    :param use_cache: Reuse transcriptions of segments already seen.
+    :param overlap_ms: Audio shared by consecutive segments, removed from the transcript at the seams.
+    :param tokenizer: The tiktoken tokenizer aligning overlapping text (required with overlap_ms).
+    :param checkpoint: Optional job_store.Checkpoint of the segment results (see iter_transcriptions).
+    :return: The full transcript (a dictionary for the json formats).
+    """
+    offsets = []
+
+    def track_offsets():
+        for file_path in file_paths:
+            offsets.append(getattr(file_path, "offset_ms", None))
+            yield file_path
+
+    merger = transcript_utils.TranscriptMerger(response_format, overlap_ms, tokenizer)
+    missing_segments = []
+    for index, transcription_data in iter_transcriptions(
+        track_offsets(),
+        client,
+        language,
+        prompt,
+        response_format,
+        max_workers,
+        progress_callback,
+        use_cache,
+        checkpoint,
+    ):
+        if transcription_data is None:
+            missing_segments.append(index)
+            continue
+        piece = merger.add(transcription_data, offsets[index])
+        if output_file is not None and piece:
+            output_file.write(piece)
+            output_file.flush()
+    if output_file is not None:
+        output_file.write(merger.flush())
+
+    if missing_segments:
+        print(f"Warning: segments {missing_segments} are missing from the transcript.")
+    if use_cache:
+        cache_stats = get_transcription_cache().stats()
+        print(
+            f"Transcription cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses."
+        )
+    full_transcript = merger.result()
     return full_transcript
@@ -0,0 +1,129 @@
+import os
+import threading
+
+import openai
+from dotenv import dotenv_values, load_dotenv
+
+import async_utils
+
+ENV_FILE = ".env"
+CREDENTIAL_VARIABLES = ("OPENAI_API_KEY", "OPENAI_ORG", "OPENAI_BASE_URL")
+
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_EXPIRY = 60
+
+_clients = {}
+_lock = threading.Lock()
+_env_mtime = None
+_env_values = {}
+
+
+def load_credentials():
+    """
+    Returns the (api_key, organization, base_url) credentials.
+
+    Variables exported in the environment take precedence over the .env file.
+    The .env file is only re-read when it changed on disk, so callers can ask for
+    credentials on every request without file I/O. An edit of the file updates
+    the variables that came from it, never the exported ones.
+    """
+    global _env_mtime, _env_values
+    try:
+        mtime = os.path.getmtime(ENV_FILE)
+    except OSError:
+        mtime = None
+    if mtime != _env_mtime:
+        load_dotenv(ENV_FILE)
+        values = dotenv_values(ENV_FILE) if mtime is not None else {}
+        for variable in CREDENTIAL_VARIABLES:
+            current = os.environ.get(variable)
+            # A value still equal to the previous .env value was loaded from it
+            if current is None or current != _env_values.get(variable):
+                continue
+            if values.get(variable) is None:
+                del os.environ[variable]
+            else:
+                os.environ[variable] = values[variable]
+        _env_values = values
+        _env_mtime = mtime
+    return (
+        os.getenv("OPENAI_API_KEY"),
+        os.getenv("OPENAI_ORG"),
+        os.getenv("OPENAI_BASE_URL"),
+    )
+
+
+def pool_size():
+    """
+    Number of pooled connections: enough for every endpoint at its maximum concurrency.
+    """
+    return sum(async_utils.ENDPOINT_CONCURRENCY.values())
+
+
+def connection_limits():
+    size = pool_size()
+    # Built with the limits class of the HTTP library openai itself depends on,
+    # which its DefaultHttpxClient expects
+    limits_class = type(openai.DEFAULT_CONNECTION_LIMITS)
+    return limits_class(
+        max_connections=size,
+        max_keepalive_connections=size,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def _get(kind, api_key, organization):
+    credentials = load_credentials()
+    key = (
+        kind,
+        api_key or credentials[0],
+        organization or credentials[1],
+        credentials[2],
+    )
+    with _lock:
+        if key not in _clients:
+            if kind == "async":
+                client_class = openai.AsyncOpenAI
+                http_client = openai.DefaultAsyncHttpxClient(limits=connection_limits())
+            else:
+                client_class = openai.OpenAI
+                http_client = openai.DefaultHttpxClient(limits=connection_limits())
+            _clients[key] = client_class(
+                api_key=key[1],
+                organization=key[2],
+                base_url=key[3],
+                http_client=http_client,
+                max_retries=0,  # Retries are handled by rate_limiter
+            )
+        return _clients[key]
+
+
+def get_client(api_key=None, organization=None):
+    """
+    Returns the process-wide OpenAI client, created on first use.
+
+    A new client (and connection pool) is only built when the credentials change.
+
+    :param api_key: API key overriding OPENAI_API_KEY.
+    :param organization: Organization overriding OPENAI_ORG.
+    :return: The shared OpenAI client.
+    """
+    return _get("sync", api_key, organization)
+
+
+def get_async_client(api_key=None, organization=None):
+    """
+    Returns the process-wide AsyncOpenAI client used on the shared event loop.
+
+    :param api_key: API key overriding OPENAI_API_KEY.
+    :param organization: Organization overriding OPENAI_ORG.
+    :return: The shared AsyncOpenAI client.
+    """
+    return _get("async", api_key, organization)
+
+
+def async_client_for(client):
+    """
+    Returns the shared AsyncOpenAI client with the same credentials as a sync client.
+    """
+    return get_async_client(client.api_key, client.organization)
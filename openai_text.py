@@ -1,66 +1,291 @@
+import asyncio
 import os
+import threading
+import time
+from functools import lru_cache
 
-import openai
-import tiktoken
-from dotenv import load_dotenv
-from openai import OpenAI
+import async_utils
+import cache_utils
+import metrics
+import openai_client
+import rate_limiter
 
 
-# Load environment variables
-def intitialize_openai():
-    load_dotenv()
+# Completion cache settings: disk size, entry lifetime and hot entries kept in memory
+COMPLETION_CACHE_BYTES = 50 * 1024 * 1024
+COMPLETION_CACHE_TTL_SECONDS = 30 * 24 * 3600
+COMPLETION_CACHE_MEMORY_ENTRIES = 256
 
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    OPENAI_ORG = os.getenv("OPENAI_ORG")
-    openai.api_key = OPENAI_API_KEY
+_completion_cache = None
 
-    client = OpenAI(
-        organization=OPENAI_ORG,
-    )
-    return client
+
+# Return the shared OpenAI client (see openai_client)
+def intitialize_openai():
+    return openai_client.get_client()
 
 
+@lru_cache(maxsize=None)
 def initialize_tokenizer(tokenizer_name):
     """
-    Initializes and returns a tokenizer.
+    Initializes and returns a tokenizer, once per process.
+
+    The BPE ranks are downloaded once into the cache directory (unless
+    TIKTOKEN_CACHE_DIR is set) and read from there on later runs.
 
     :param tokenizer_name: Name of the tokenizer to initialize.
     :return: Initialized tokenizer.
     """
+    os.environ.setdefault(
+        "TIKTOKEN_CACHE_DIR", str(cache_utils.cache_path("tiktoken"))
+    )
+    import tiktoken
 
     return tiktoken.get_encoding(tokenizer_name)
 
 
+def prewarm_tokenizer(tokenizer_name):
+    """
+    Loads a tokenizer in a background thread, so that it is ready when first needed.
+    """
+    threading.Thread(
+        target=initialize_tokenizer, args=(tokenizer_name,), daemon=True
+    ).start()
+
+
+def sentence_boundaries(tokens, tokenizer):
+    """
+    Precomputes, for every position j, the last sentence boundary at or before j.
+
+    A boundary at j means the text of tokens[:j] ends with a period or a newline.
+    Every token is decoded exactly once.
+
+    :param tokens: The encoded text.
+    :param tokenizer: The tokenizer used to encode the text.
+    :return: A list where entry j is the largest boundary <= j (0 if none).
+    """
+    last_boundary = [0] * (len(tokens) + 1)
+    for j, token_bytes in enumerate(tokenizer.decode_tokens_bytes(tokens), start=1):
+        if token_bytes.endswith(b".") or token_bytes.endswith(b"\n"):
+            last_boundary[j] = j
+        else:
+            last_boundary[j] = last_boundary[j - 1]
+    return last_boundary
+
+
 def create_chunks(text, chunk_size, tokenizer):
     """
     Yields successive chunk_size-sized chunks from text.
 
+    Each chunk ends at the last period or newline between 0.5 and 1.5 chunk_size
+    tokens, or is cut at chunk_size tokens when there is none. Runs in linear time.
+
     :param text: The text to be chunked.
     :param chunk_size: The desired size of each chunk.
     :param tokenizer: The tokenizer to use for chunking.
     :return: Yields chunks of text.
     """
     tokens = tokenizer.encode(text)
+    last_boundary = sentence_boundaries(tokens, tokenizer)
     i = 0
     while i < len(tokens):
         j = min(i + int(1.5 * chunk_size), len(tokens))
-        while j > i + int(0.5 * chunk_size):
-            chunk = tokenizer.decode(tokens[i:j])
-            if chunk.endswith(".") or chunk.endswith("\n"):
-                break
-            j -= 1
-        if j == i + int(0.5 * chunk_size):
-            j = min(i + chunk_size, len(tokens))
+        lower = i + int(0.5 * chunk_size)
+        if j >= lower:
+            boundary = last_boundary[j]
+            j = boundary if boundary > lower else min(i + chunk_size, len(tokens))
         yield tokens[i:j]
         i = j
 
 
+def get_completion_cache():
+    """
+    Returns the completion cache (in-memory LRU over SQLite), opened on first use.
+    """
+    global _completion_cache
+    if _completion_cache is None:
+        _completion_cache = cache_utils.TieredCache(
+            cache_utils.MemoryLRU(COMPLETION_CACHE_MEMORY_ENTRIES),
+            cache_utils.SQLiteCache(
+                cache_utils.cache_path("completions.sqlite"),
+                COMPLETION_CACHE_BYTES,
+                COMPLETION_CACHE_TTL_SECONDS,
+            ),
+        )
+    return _completion_cache
+
+
+def record_usage(model, usage):
+    """
+    Counts the prompt and completion tokens reported by a chat completion.
+    """
+    if usage is None:
+        return
+    metrics.add("tokens", usage.prompt_tokens, model=model, kind="prompt")
+    metrics.add("tokens", usage.completion_tokens, model=model, kind="completion")
+
+
+def is_deterministic(temperature):
+    """
+    Returns True when a completion is reproducible enough to be cached (temperature 0).
+    """
+    return float(temperature) == 0
+
+
+async def aopenai_completion(
+    model: str,
+    input_text: str,
+    system_prompt: str,
+    format="text",
+    temperature: float = 0,
+    client=None,
+    use_cache=None,
+):
+    """
+    Coroutine version of openai_completion, run on the shared event loop.
+
+    Requests go through the shared 'chat.completions' rate limiter of the model,
+    which retries rate-limit and server errors.
+
+    :param client: AsyncOpenAI client (defaults to one built from the environment variables).
+    :param use_cache: Memoize the completion (default: only for deterministic temperatures).
+    :return: The generated text from the API.
+    """
+    if use_cache is None:
+        use_cache = is_deterministic(temperature)
+    with metrics.span("completion", model=model) as span:
+        if use_cache:
+            cache = get_completion_cache()
+            cache_key = cache_utils.make_key(
+                model, system_prompt, input_text, format, float(temperature)
+            )
+            # SQLite reads and writes (and eviction) block, keep them off the event loop
+            completion = await asyncio.to_thread(cache.get, cache_key)
+            span["cached"] = completion is not None
+            if completion is not None:
+                return completion
+
+        client = client or openai_client.get_async_client()
+
+        async def request():
+            return await client.chat.completions.with_raw_response.create(
+                model=model,
+                temperature=temperature,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": input_text},
+                ],
+                response_format={"type": format},
+            )
+
+        response = await rate_limiter.get_limiter("chat.completions", model).call(
+            request,
+            # The output of the cleaning and note prompts is about as long as the input
+            rate_limiter.estimate_tokens(system_prompt, input_text, input_text),
+        )
+        record_usage(model, response.usage)
+        completion = response.choices[0].message.content
+        if use_cache and completion is not None:
+            await asyncio.to_thread(cache.set, cache_key, completion)
+        return completion
+
+
+async def astream_completion(
+    model: str,
+    input_text: str,
+    system_prompt: str,
+    format="text",
+    temperature: float = 0,
+    client=None,
+    use_cache=None,
+):
+    """
+    Streaming version of aopenai_completion: yields the text deltas as they arrive.
+
+    A cached completion is yielded in one piece; a streamed one is cached once complete.
+
+    :param client: AsyncOpenAI client (defaults to one built from the environment variables).
+    :param use_cache: Memoize the completion (default: only for deterministic temperatures).
+    :return: Yields the generated text piece by piece.
+    """
+    if use_cache is None:
+        use_cache = is_deterministic(temperature)
+    with metrics.span("completion", model=model, stream=True) as span:
+        if use_cache:
+            cache = get_completion_cache()
+            cache_key = cache_utils.make_key(
+                model, system_prompt, input_text, format, float(temperature)
+            )
+            completion = await asyncio.to_thread(cache.get, cache_key)
+            span["cached"] = completion is not None
+            if completion is not None:
+                yield completion
+                return
+
+        client = client or openai_client.get_async_client()
+
+        async def request():
+            return await client.chat.completions.with_raw_response.create(
+                model=model,
+                temperature=temperature,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": input_text},
+                ],
+                response_format={"type": format},
+                stream=True,
+                # The last chunk then reports the tokens used
+                stream_options={"include_usage": True},
+            )
+
+        # The stream occupies a connection until read, so it keeps its limiter slot
+        limiter = rate_limiter.get_limiter("chat.completions", model)
+        stream = await limiter.call(
+            request,
+            rate_limiter.estimate_tokens(system_prompt, input_text, input_text),
+            hold=True,
+        )
+        try:
+            deltas = []
+            async for chunk in stream:
+                record_usage(model, chunk.usage)
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    deltas.append(delta)
+                    yield delta
+            if use_cache:
+                await asyncio.to_thread(cache.set, cache_key, "".join(deltas))
+        finally:
+            await stream.close()
+            await limiter.release()
+
+
+def stream_completion(
+    model: str,
+    input_text: str,
+    system_prompt: str,
+    format="text",
+    temperature: float = 0,
+    use_cache=None,
+):
+    """
+    Generates a response like openai_completion, yielding text deltas as they arrive.
+
+    :return: Yields the generated text piece by piece.
+    """
+    return async_utils.iterate_sync(
+        astream_completion(
+            model, input_text, system_prompt, format, temperature, use_cache=use_cache
+        )
+    )
+
+
 def openai_completion(
     model: str,
     input_text: str,
     system_prompt: str,
     format="text",
     temperature: float = 0,
+    use_cache=None,
 ):
     """
     Generates a response from OpenAI's API based on the given model, input text, and system prompt.
@@ -69,16 +294,90 @@ def openai_completion(
     :param input_text: The user input text for the completion.
     :param system_prompt: The system prompt that guides the response generation.
     :param temperature: The temperature setting for the completion (default 0 for deterministic responses).
+    :param use_cache: Memoize the completion (default: only for deterministic temperatures).
     :return: The generated text from the API.
     """
-    client = intitialize_openai()
-    response = client.chat.completions.create(
-        model=model,
-        temperature=temperature,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": input_text},
-        ],
-        response_format={"type": format},
+    return async_utils.run_sync(
+        aopenai_completion(
+            model, input_text, system_prompt, format, temperature, use_cache=use_cache
+        )
+    )
+
+
+async def aparallel_completion(
+    model: str,
+    input_texts,
+    system_prompt: str,
+    format="text",
+    temperature: float = 0,
+    max_concurrency: int = 8,
+    progress_callback=None,
+    checkpoint=None,
+):
+    """
+    Runs one completion per input text concurrently and returns them in input order.
+
+    Retryable errors are retried by the shared rate limiter (see
+    rate_limiter.RateLimiter.call); a text that still fails gives None instead
+    of failing the whole batch.
+
+    :param input_texts: The user input texts, e.g. the chunks of a transcript.
+    :param max_concurrency: The maximum number of completions in flight for this call.
+    :param progress_callback: Called as progress_callback(index, latency_seconds) when a text
+        completes, the latency including the limiter's retries.
+    :param checkpoint: Optional job_store.Checkpoint: texts with a saved completion are
+        not sent again, and each new completion is saved as soon as it arrives.
+    :return: The list of generated texts (None for failed texts).
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def complete(index, input_text):
+        if checkpoint is not None:
+            saved = await asyncio.to_thread(checkpoint.get, index)
+            if saved is not None:
+                return saved
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                completion = await aopenai_completion(
+                    model, input_text, system_prompt, format, temperature
+                )
+            except Exception as e:
+                print(f"Chunk {index} failed: {e}")
+                return None
+            if progress_callback:
+                progress_callback(index, time.perf_counter() - start)
+            if checkpoint is not None:
+                await asyncio.to_thread(checkpoint.set, index, completion)
+            return completion
+
+    return await asyncio.gather(
+        *(complete(index, input_text) for index, input_text in enumerate(input_texts))
+    )
+
+
+def parallel_completion(
+    model: str,
+    input_texts,
+    system_prompt: str,
+    format="text",
+    temperature: float = 0,
+    max_concurrency: int = 8,
+    progress_callback=None,
+    checkpoint=None,
+):
+    """
+    Sync wrapper of aparallel_completion.
+    """
+    return async_utils.run_sync(
+        aparallel_completion(
+            model,
+            input_texts,
+            system_prompt,
+            format,
+            temperature,
+            max_concurrency,
+            progress_callback,
+            checkpoint,
+        )
     )
-    return response.choices[0].message.content
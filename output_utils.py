@@ -5,9 +5,9 @@ from argparse import FileType
 from datetime import datetime
 
 
-def save_to_file(content, filename, output_directory, filetype="txt"):
+def get_output_path(filename, output_directory, filetype="txt"):
     """
-    Save the content to a file with the specified filename and filetype.
+    Build the output path for a filename and create the output directory if needed.
     """
     filename = os.path.basename(os.path.splitext(filename)[0])
     full_filename = os.path.join(output_directory, f"{filename}.{filetype}")
@@ -15,6 +15,23 @@ def save_to_file(content, filename, output_directory, filetype="txt"):
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
         print(f"Created directory: {output_directory}")
+    return full_filename
+
+
+def open_output_file(filename, output_directory, filetype="txt"):
+    """
+    Open the output file for incremental writing, e.g. a transcript in progress.
+    """
+    return open(
+        get_output_path(filename, output_directory, filetype), "w", encoding="utf-8"
+    )
+
+
+def save_to_file(content, filename, output_directory, filetype="txt"):
+    """
+    Save the content to a file with the specified filename and filetype.
+    """
+    full_filename = get_output_path(filename, output_directory, filetype)
 
     try:
         with open(full_filename, "w", encoding="utf-8") as file:
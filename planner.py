@@ -0,0 +1,291 @@
+import math
+
+import audio_utils
+import rate_limiter
+
+# Segment lengths considered by the planner, in seconds
+CANDIDATE_SEGMENT_SECONDS = [10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 600]
+
+# Transcription latency model: fixed cost per request + cost per second of audio,
+# refined by record_transcription_latency from the requests actually made
+latency_model = {"base_seconds": 1.5, "seconds_per_audio_second": 0.08}
+
+# Weight of each new observation in the latency model (exponential moving average)
+LATENCY_SMOOTHING = 0.2
+
+
+def record_transcription_latency(audio_ms, seconds):
+    """
+    Updates the latency model with the duration of one transcription request.
+
+    :param audio_ms: The duration of the transcribed segment in milliseconds.
+    :param seconds: The wall-clock duration of the request.
+    """
+    if not audio_ms:
+        return
+    per_second = max(0.0, seconds - latency_model["base_seconds"]) / (audio_ms / 1000)
+    latency_model["seconds_per_audio_second"] += LATENCY_SMOOTHING * (
+        per_second - latency_model["seconds_per_audio_second"]
+    )
+
+
+def transcription_latency(segment_seconds):
+    """
+    Expected duration of one transcription request for a segment of this length.
+    """
+    return (
+        latency_model["base_seconds"]
+        + latency_model["seconds_per_audio_second"] * segment_seconds
+    )
+
+
+def expected_wall_time(
+    segments, segment_seconds, workers, requests_per_minute, burst=1
+):
+    """
+    Expected wall-clock time to transcribe this many segments of this length.
+
+    Segments run in waves of `workers` requests, unless the requests-per-minute
+    limit is the bottleneck.
+
+    :param burst: The requests the limiter lets through at once (its bucket starts
+        full); only the requests beyond it are spaced by the requests-per-minute limit.
+    """
+    latency = transcription_latency(segment_seconds)
+    concurrency_time = math.ceil(segments / workers) * latency
+    rate_time = max(0, segments - max(1, burst)) / requests_per_minute * 60 + latency
+    return max(concurrency_time, rate_time)
+
+
+def request_burst(limiter):
+    """
+    The requests a limiter can send right now without waiting for its rate limit.
+    """
+    if not limiter.requests:
+        return math.inf
+    limiter.requests.refill()
+    return int(limiter.requests.tokens)
+
+
+def plan_segmentation(duration_ms, audio, encoding, overlap_ms=0, model="whisper-1"):
+    """
+    Picks the segment length and worker count minimising the expected wall-clock time.
+
+    Takes into account the recording length, the upload byte budget of the encoding,
+    the latency observed so far and the limits of the transcription endpoint.
+
+    :param duration_ms: The duration of the audio to transcribe in milliseconds.
+    :param audio: An AudioSegment in the sample format of the segments, to size the upload budget.
+    :param encoding: Settings from audio_utils.upload_encoding.
+    :param overlap_ms: Audio shared by consecutive segments.
+    :param model: The transcription model, to look up its rate limiter.
+    :return: A dictionary with duration_ms, segment_duration_ms, workers, segments and expected_seconds.
+    """
+    limiter = rate_limiter.get_limiter("audio.transcriptions", model)
+    max_workers = max(1, int(limiter.max_concurrency()))
+    requests_per_minute = limiter.requests.capacity if limiter.requests else math.inf
+    budget_ms = audio_utils.max_segment_duration_ms(audio, encoding) - overlap_ms
+    candidates = [
+        seconds * 1000
+        for seconds in CANDIDATE_SEGMENT_SECONDS
+        if seconds * 1000 <= budget_ms
+    ] or [budget_ms]
+
+    best = None
+    for segment_duration_ms in candidates:
+        segments = max(1, math.ceil(duration_ms / segment_duration_ms))
+        workers = min(max_workers, segments)
+        # Overlap makes every upload longer without covering more of the recording
+        expected = expected_wall_time(
+            segments,
+            (segment_duration_ms + overlap_ms) / 1000,
+            workers,
+            requests_per_minute,
+            request_burst(limiter),
+        )
+        # Ties go to longer segments: fewer requests for the same wall-clock time
+        if best is None or expected <= best["expected_seconds"]:
+            best = {
+                "duration_ms": duration_ms,
+                "segment_duration_ms": segment_duration_ms,
+                "workers": workers,
+                "segments": segments,
+                "expected_seconds": expected,
+            }
+        if segments == 1:
+            break
+    return best
+
+
+def report_plan(plan):
+    print(
+        f"Plan: {plan['segments']} segments of {plan['segment_duration_ms'] / 1000:.0f}s "
+        f"on {plan['workers']} workers, expected transcription time "
+        f"{plan['expected_seconds']:.0f}s."
+    )
+
+
+# Dollars per audio minute for transcription, per million tokens (input, output) for chat
+PRICES = {
+    "whisper-1": {"minute": 0.006},
+    "gpt-3.5-turbo": {"input": 0.50, "output": 1.50},
+    "gpt-4-1106-preview": {"input": 10.00, "output": 30.00},
+    "gpt-4": {"input": 30.00, "output": 60.00},
+}
+
+# The Batch API bills requests at half price
+BATCH_API_DISCOUNT = 0.5
+
+# Tokens of transcript per minute of speech (about 150 words a minute)
+TOKENS_PER_AUDIO_MINUTE = 200
+NOTE_OUTPUT_TOKENS = 1000
+
+# Generation speed of the chat models, in output tokens per second
+OUTPUT_TOKENS_PER_SECOND = {"gpt-3.5-turbo": 60}
+DEFAULT_OUTPUT_TOKENS_PER_SECOND = 20
+COMPLETION_BASE_SECONDS = 1.0
+
+CLEANING_MODEL = "gpt-3.5-turbo"
+CLEANING_CHUNK_TOKENS = 2000
+
+# Applied in order while a job is over budget: (setting, value, description)
+DOWNGRADES = [
+    ("model", CLEANING_MODEL, f"writing the note with {CLEANING_MODEL}"),
+    ("cleaning", False, "skipping the cleaning"),
+]
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+def chat_cost(model, input_tokens, output_tokens, batch_api=False):
+    price = PRICES.get(model, PRICES["gpt-4"])
+    dollars = (input_tokens * price["input"] + output_tokens * price["output"]) / 1e6
+    return dollars * BATCH_API_DISCOUNT if batch_api else dollars
+
+
+def completion_seconds(model, output_tokens):
+    speed = OUTPUT_TOKENS_PER_SECOND.get(model, DEFAULT_OUTPUT_TOKENS_PER_SECOND)
+    return COMPLETION_BASE_SECONDS + output_tokens / speed
+
+
+def estimate_job(plan, settings, prompt_tokens, transcript_tokens=None):
+    """
+    Estimates the cost and wall-clock time of each stage of a job before it runs.
+
+    :param plan: The segmentation plan (duration_ms, segment_duration_ms, workers).
+    :param settings: The job settings: overlap_ms, cleaning, cleaning_concurrency, model, batch_api.
+    :param prompt_tokens: Token counts of the "cleaning" and "note" system prompts.
+    :param transcript_tokens: Token count of the transcript once known, otherwise
+        estimated from the audio duration.
+    :return: A dictionary of stage estimates, with the total dollars and seconds.
+    """
+    minutes = plan["duration_ms"] / 60000
+    segments = max(1, math.ceil(plan["duration_ms"] / plan["segment_duration_ms"]))
+    upload_minutes = minutes + segments * settings["overlap_ms"] / 60000
+    limiter = rate_limiter.get_limiter("audio.transcriptions", "whisper-1")
+    transcription = {
+        "minutes": upload_minutes,
+        "dollars": upload_minutes * PRICES["whisper-1"]["minute"],
+        "seconds": expected_wall_time(
+            segments,
+            (plan["segment_duration_ms"] + settings["overlap_ms"]) / 1000,
+            min(plan["workers"] or limiter.max_concurrency(), segments),
+            limiter.requests.capacity if limiter.requests else math.inf,
+            request_burst(limiter),
+        ),
+    }
+    if transcript_tokens is None:
+        transcript_tokens = int(minutes * TOKENS_PER_AUDIO_MINUTE)
+    estimate = {"transcription": transcription}
+
+    if settings["cleaning"]:
+        chunks = max(1, math.ceil(transcript_tokens / CLEANING_CHUNK_TOKENS))
+        input_tokens = transcript_tokens + chunks * prompt_tokens["cleaning"]
+        waves = math.ceil(chunks / settings["cleaning_concurrency"])
+        estimate["cleaning"] = {
+            "input_tokens": input_tokens,
+            "output_tokens": transcript_tokens,
+            "dollars": chat_cost(
+                CLEANING_MODEL, input_tokens, transcript_tokens, settings["batch_api"]
+            ),
+            "seconds": waves
+            * completion_seconds(
+                CLEANING_MODEL, min(transcript_tokens, CLEANING_CHUNK_TOKENS)
+            ),
+        }
+
+    input_tokens = transcript_tokens + prompt_tokens["note"]
+    estimate["note"] = {
+        "input_tokens": input_tokens,
+        "output_tokens": NOTE_OUTPUT_TOKENS,
+        "dollars": chat_cost(
+            settings["model"], input_tokens, NOTE_OUTPUT_TOKENS, settings["batch_api"]
+        ),
+        "seconds": completion_seconds(settings["model"], NOTE_OUTPUT_TOKENS),
+    }
+    stages = list(estimate.values())
+    estimate["dollars"] = sum(stage["dollars"] for stage in stages)
+    estimate["seconds"] = sum(stage["seconds"] for stage in stages)
+    return estimate
+
+
+def fit_budget(plan, settings, prompt_tokens, budget, transcript_tokens=None):
+    """
+    Downgrades the job settings (see DOWNGRADES) until its estimate fits the budget.
+
+    Once the transcript is known (transcript_tokens given), the transcription has
+    been paid for: its cost is taken out of the budget, and only the cleaning and
+    note estimates must fit in what is left.
+
+    :param budget: The maximum cost of the job in dollars, None for no limit.
+    :return: The settings to use and their estimate.
+    :raises BudgetExceededError: When the job is over budget even fully downgraded.
+    """
+    estimate = estimate_job(plan, settings, prompt_tokens, transcript_tokens)
+    if budget is None:
+        return settings, estimate
+    spent = estimate["transcription"]["dollars"] if transcript_tokens is not None else 0
+    remaining_budget = budget - spent
+    described = "budget" if not spent else "budget left after the transcription"
+
+    def remaining_cost(estimate):
+        return estimate["dollars"] - spent
+
+    for setting, value, description in DOWNGRADES:
+        if remaining_cost(estimate) <= remaining_budget:
+            break
+        if settings[setting] == value:
+            continue
+        print(
+            f"Estimated cost ${remaining_cost(estimate):.2f} is over the "
+            f"${remaining_budget:.2f} {described}: {description}."
+        )
+        settings = {**settings, setting: value}
+        estimate = estimate_job(plan, settings, prompt_tokens, transcript_tokens)
+    if remaining_cost(estimate) > remaining_budget:
+        raise BudgetExceededError(
+            f"Estimated cost ${remaining_cost(estimate):.2f} is over the "
+            f"${remaining_budget:.2f} {described}."
+        )
+    return settings, estimate
+
+
+def report_estimate(estimate, batch_api=False):
+    for stage in ("transcription", "cleaning", "note"):
+        if stage not in estimate:
+            continue
+        details = estimate[stage]
+        if stage == "transcription":
+            amount = f"{details['minutes']:.1f} audio minutes"
+        else:
+            amount = f"{details['input_tokens']} + {details['output_tokens']} tokens"
+        print(
+            f"Estimate {stage}: {amount}, ${details['dollars']:.3f}, "
+            f"{details['seconds']:.0f}s"
+        )
+    wait = " (Batch API results can take up to 24 hours)" if batch_api else ""
+    print(
+        f"Estimate total: ${estimate['dollars']:.3f}, {estimate['seconds']:.0f}s{wait}."
+    )
@@ -0,0 +1,239 @@
+import asyncio
+import random
+import re
+import time
+
+import openai
+
+import async_utils
+import metrics
+
+# Default (requests per minute, tokens per minute) per endpoint, refined from the response headers
+DEFAULT_LIMITS = {
+    "audio.transcriptions": (50, None),
+    "audio.speech": (50, None),
+    "chat.completions": (500, 200000),
+}
+
+MAX_RETRIES = 6
+MAX_BACKOFF_SECONDS = 60
+
+_limiters = {}
+
+
+def parse_reset_duration(value):
+    """
+    Parses a rate-limit reset duration such as '1s', '6m0s', '20ms' or '0.5' into seconds.
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def retry_delay(error, attempt):
+    """
+    Computes how long to wait before retrying a failed request.
+
+    Uses the retry-after headers when the server sends them, then the rate-limit
+    reset headers, and falls back to exponential backoff with jitter.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    for header in (
+        "retry-after",
+        "x-ratelimit-reset-requests",
+        "x-ratelimit-reset-tokens",
+    ):
+        delay = parse_reset_duration(headers.get(header))
+        if delay is not None:
+            return min(delay, MAX_BACKOFF_SECONDS)
+    return min(2**attempt, MAX_BACKOFF_SECONDS) * random.uniform(0.5, 1.5)
+
+
+def is_retryable(error):
+    """
+    Returns True for errors worth retrying: 429 (except exhausted quota), 5xx and connection errors.
+    """
+    if isinstance(error, openai.RateLimitError):
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return isinstance(error, openai.APIConnectionError)
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously at capacity tokens per minute.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.capacity / 60
+        )
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        # Requests larger than the bucket wait for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        while True:
+            self.refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) * 60 / self.capacity)
+
+    def sync(self, limit, remaining):
+        # Align the bucket with the limits reported by the server
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.refill()
+            self.tokens = min(self.tokens, remaining)
+
+
+class RateLimiter:
+    """
+    Shared limiter for one (endpoint, model) pair.
+
+    Combines a requests-per-minute and a tokens-per-minute bucket with an adaptive
+    concurrency limit: it grows by one slot per window of successful requests and
+    is halved on every 429, never exceeding async_utils.ENDPOINT_CONCURRENCY.
+    All methods run on the shared event loop of async_utils.
+    """
+
+    def __init__(self, endpoint, model, requests_per_minute=None, tokens_per_minute=None):
+        self.endpoint = endpoint
+        self.model = model
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = float(self.max_concurrency())
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.retries = 0
+        self.throttled = 0
+        self._condition = None
+
+    def max_concurrency(self):
+        return async_utils.ENDPOINT_CONCURRENCY[self.endpoint]
+
+    async def acquire(self, tokens=0):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.in_flight < max(1, int(self.concurrency))
+            )
+            self.in_flight += 1
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        if self.requests:
+            await self.requests.acquire()
+        if self.tokens and tokens:
+            await self.tokens.acquire(tokens)
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, headers):
+        self.concurrency = min(
+            self.max_concurrency(), self.concurrency + 1 / max(1, self.concurrency)
+        )
+        for name, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            limit = headers.get(f"x-ratelimit-limit-{name}")
+            remaining = headers.get(f"x-ratelimit-remaining-{name}")
+            if bucket and (limit or remaining):
+                bucket.sync(
+                    int(limit) if limit else None,
+                    int(remaining) if remaining else None,
+                )
+            if remaining == "0":
+                # Wait for the window to reset instead of triggering 429s
+                reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{name}"))
+                self.pause(reset or 1)
+
+    def on_throttled(self, delay):
+        self.throttled += 1
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.pause(delay)
+
+    def pause(self, delay):
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    async def call(self, request, tokens=0, hold=False):
+        """
+        Runs a request under the limiter, retrying 429, 5xx and connection errors.
+
+        :param request: A coroutine function returning a raw response (client.<endpoint>.with_raw_response.create).
+        :param tokens: The estimated tokens used by the request, for the tokens-per-minute bucket.
+        :param hold: Keep the concurrency slot after a successful request, e.g. while
+            a streamed response is read; the caller then calls release() when done.
+        :return: The parsed response.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            await self.acquire(tokens)
+            metrics.add("requests", endpoint=self.endpoint, model=self.model)
+            succeeded = False
+            try:
+                raw_response = await request()
+                succeeded = True
+            except Exception as e:
+                if attempt == MAX_RETRIES or not is_retryable(e):
+                    metrics.add("errors", endpoint=self.endpoint, model=self.model)
+                    raise
+                delay = retry_delay(e, attempt)
+                self.retries += 1
+                metrics.add("retries", endpoint=self.endpoint, model=self.model)
+                if isinstance(e, openai.RateLimitError):
+                    metrics.add("throttled", endpoint=self.endpoint, model=self.model)
+                    self.on_throttled(delay)
+                print(
+                    f"{self.endpoint} ({self.model}) failed with {type(e).__name__}, "
+                    f"retrying in {delay:.1f}s."
+                )
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                if not (hold and succeeded):
+                    await self.release()
+            try:
+                self.on_success(raw_response.headers)
+                return raw_response.parse()
+            except BaseException:
+                if hold:
+                    await self.release()
+                raise
+
+
+def get_limiter(endpoint, model):
+    """
+    Returns the process-wide limiter of an (endpoint, model) pair.
+    """
+    key = (endpoint, model)
+    if key not in _limiters:
+        _limiters[key] = RateLimiter(endpoint, model, *DEFAULT_LIMITS[endpoint])
+    return _limiters[key]
+
+
+def estimate_tokens(*texts):
+    """
+    Rough token estimate (4 characters per token) for the tokens-per-minute bucket.
+    """
+    return sum(len(text or "") for text in texts) // 4
@@ -0,0 +1,20 @@
+from pydub import AudioSegment
+
+import audio_utils
+import planner
+
+
+def test_short_recording_uses_more_than_five_workers():
+    # The limiter's initial burst lets a 5-minute recording fan out: it must not
+    # be planned as a handful of long segments
+    audio = AudioSegment.silent(1000, frame_rate=16000)
+    plan = planner.plan_segmentation(300000, audio, audio_utils.upload_encoding("ogg"))
+    assert plan["segments"] > 5
+    assert plan["workers"] == plan["segments"]
+
+
+def test_rate_limit_applies_beyond_the_burst():
+    within = planner.expected_wall_time(50, 10, 50, 50, burst=50)
+    beyond = planner.expected_wall_time(100, 10, 50, 50, burst=50)
+    assert within == planner.transcription_latency(10)
+    assert beyond >= 60
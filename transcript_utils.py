@@ -0,0 +1,262 @@
+import re
+
+# Output file extension of each transcription response format
+FORMAT_FILETYPES = {
+    "text": "txt",
+    "srt": "srt",
+    "vtt": "vtt",
+    "json": "json",
+    "verbose_json": "json",
+}
+
+TIMESTAMP_PATTERN = re.compile(
+    r"(?:(\d+):)?(\d{1,2}):(\d{2})[,.](\d{3})\s*-->\s*(?:(\d+):)?(\d{1,2}):(\d{2})[,.](\d{3})"
+)
+
+
+def to_milliseconds(hours, minutes, seconds, milliseconds):
+    return ((int(hours or 0) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(
+        milliseconds
+    )
+
+
+def format_timestamp(milliseconds, separator=","):
+    """
+    Formats milliseconds as an srt (HH:MM:SS,mmm) or vtt (HH:MM:SS.mmm) timestamp.
+    """
+    seconds, milliseconds = divmod(int(round(milliseconds)), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+
+def parse_cues(subtitles):
+    """
+    Parses srt or vtt subtitles into a list of (start_ms, end_ms, text) cues.
+
+    Cue numbers, the WEBVTT header and cue settings are dropped.
+    """
+    cues = []
+    for block in re.split(r"\n\s*\n", subtitles.replace("\r\n", "\n").strip()):
+        lines = block.split("\n")
+        for i, line in enumerate(lines):
+            match = TIMESTAMP_PATTERN.search(line)
+            if match:
+                start = to_milliseconds(*match.groups()[:4])
+                end = to_milliseconds(*match.groups()[4:])
+                cues.append((start, end, "\n".join(lines[i + 1 :]).strip()))
+                break
+    return cues
+
+
+def longest_common_run(first, second):
+    """
+    Finds the longest run of tokens common to two token lists.
+
+    :return: (length, end index in first, end index in second) of the run.
+    """
+    best = (0, 0, 0)
+    previous_row = [0] * (len(second) + 1)
+    for i in range(1, len(first) + 1):
+        row = [0] * (len(second) + 1)
+        for j in range(1, len(second) + 1):
+            if first[i - 1] == second[j - 1]:
+                row[j] = previous_row[j - 1] + 1
+                if row[j] > best[0]:
+                    best = (row[j], i, j)
+        previous_row = row
+    return best
+
+
+def stitch_overlap(previous, following, tokenizer, max_tokens=64, min_run=3):
+    """
+    Removes the words transcribed twice where two overlapping segments meet.
+
+    The end of the previous text and the start of the following text are aligned
+    on their longest common token run; the previous text is kept up to the end of
+    the run and the following text resumes right after it.
+
+    :param previous: The text of the earlier segment.
+    :param following: The text of the later segment.
+    :param tokenizer: The tiktoken tokenizer used for the alignment.
+    :param max_tokens: How many tokens on each side of the seam are compared.
+    :param min_run: The shortest run accepted as the duplicated overlap.
+    :return: The kept previous text and the rest of the following text, to be concatenated.
+    """
+    previous_tokens = tokenizer.encode(previous)
+    # Leading space so that the first word tokenizes like it does mid-sentence
+    following = " " + following
+    following_tokens = tokenizer.encode(following)
+    tail_start = max(0, len(previous_tokens) - max_tokens)
+    length, previous_end, following_end = longest_common_run(
+        previous_tokens[tail_start:], following_tokens[:max_tokens]
+    )
+    if length < min_run:
+        return previous, following
+    return (
+        tokenizer.decode(previous_tokens[: tail_start + previous_end]),
+        tokenizer.decode(following_tokens[following_end:]),
+    )
+
+
+class TranscriptMerger:
+    """
+    Merges segment transcriptions, in order, into one transcript of the given format.
+
+    Timestamps of srt, vtt and verbose_json results are shifted by the offset of
+    their segment in the recording, and subtitle cues are renumbered. add() returns
+    the text to append to a partial output file (empty for the json formats, which
+    are only valid once complete).
+
+    With overlap_ms, segments are expected to overlap their successor by that much
+    audio: text is de-duplicated with stitch_overlap (which holds back the latest
+    segment until the next one arrives), and timed cues, segments and words that
+    start before the end of what was already merged are dropped.
+    """
+
+    def __init__(self, response_format, overlap_ms=0, tokenizer=None):
+        self.response_format = response_format
+        self.overlap_ms = overlap_ms
+        self.tokenizer = tokenizer
+        self.max_overlap_tokens = 16 + overlap_ms * 8 // 1000
+        self.pieces = []
+        self.held = None
+        self.cues = 0
+        self.end_ms = 0
+        self.merged = None
+
+    def _stitch(self, text):
+        text = text.strip()
+        if self.held is None:
+            self.held = text
+            return ""
+        kept, self.held = stitch_overlap(
+            self.held, text, self.tokenizer, self.max_overlap_tokens
+        )
+        self.pieces.append(kept)
+        return kept
+
+    def _overlaps(self, start_ms):
+        return self.overlap_ms and start_ms < self.end_ms
+
+    def add(self, transcription, offset_ms=None):
+        """
+        Adds the transcription of the next segment.
+
+        :param transcription: The transcription data of the segment (str or dict).
+        :param offset_ms: The segment position in the recording (defaults to the end of the previous one).
+        :return: The text to append to a partial output file.
+        """
+        if offset_ms is None:
+            offset_ms = self.end_ms
+        if self.response_format in ("srt", "vtt"):
+            return self._add_subtitles(transcription, offset_ms)
+        if self.response_format == "verbose_json":
+            self._add_verbose_json(transcription, offset_ms)
+            return ""
+        if self.overlap_ms and self.tokenizer and self.response_format == "json":
+            self._stitch(transcription["text"])
+            return ""
+        if self.response_format == "json":
+            self.pieces.append(transcription["text"])
+            return ""
+        if self.overlap_ms and self.tokenizer:
+            return self._stitch(transcription)
+        piece = transcription if not self.pieces else " " + transcription
+        self.pieces.append(transcription)
+        return piece
+
+    def _add_subtitles(self, subtitles, offset_ms):
+        separator = "," if self.response_format == "srt" else "."
+        piece = "WEBVTT\n\n" if self.response_format == "vtt" and not self.cues else ""
+        for start, end, text in parse_cues(subtitles):
+            start, end = start + offset_ms, end + offset_ms
+            if self._overlaps(start):
+                continue
+            self.cues += 1
+            self.end_ms = max(self.end_ms, end)
+            timing = f"{format_timestamp(start, separator)} --> {format_timestamp(end, separator)}"
+            piece += f"{self.cues}\n{timing}\n{text}\n\n"
+        self.pieces.append(piece)
+        return piece
+
+    def _add_verbose_json(self, transcription, offset_ms):
+        offset = offset_ms / 1000
+        if self.merged is None:
+            self.merged = {
+                key: value
+                for key, value in transcription.items()
+                if key not in ("text", "segments", "words", "duration")
+            }
+            self.merged.update(text="", segments=[], words=[], duration=0)
+        self.merged["text"] = " ".join(
+            text for text in (self.merged["text"], transcription["text"]) if text
+        )
+        merged_end_ms = self.end_ms
+        for segment in transcription.get("segments") or []:
+            if self._overlaps((segment["start"] + offset) * 1000):
+                continue
+            segment = dict(segment)
+            segment["id"] = len(self.merged["segments"])
+            segment["start"] += offset
+            segment["end"] += offset
+            if "seek" in segment:
+                segment["seek"] += int(offset_ms // 10)
+            self.merged["segments"].append(segment)
+        for word in transcription.get("words") or []:
+            if self.overlap_ms and (word["start"] + offset) * 1000 < merged_end_ms:
+                continue
+            word = dict(word)
+            word["start"] += offset
+            word["end"] += offset
+            self.merged["words"].append(word)
+        end = offset + float(transcription.get("duration") or 0)
+        self.merged["duration"] = max(self.merged["duration"], end)
+        if self.overlap_ms:
+            # The plain text is rebuilt from the kept segments, without the duplicates
+            self.merged["text"] = "".join(
+                segment["text"] for segment in self.merged["segments"]
+            ).strip()
+            # Only what was kept counts as merged, the overlap is in the next segment
+            self.end_ms = max(
+                [self.end_ms]
+                + [segment["end"] * 1000 for segment in self.merged["segments"][-1:]]
+            )
+        else:
+            self.end_ms = max(self.end_ms, int(end * 1000))
+
+    def result(self):
+        """
+        Returns the merged transcript: a string, or a dictionary for the json formats.
+        """
+        if self.response_format == "verbose_json":
+            return self.merged or {"text": "", "segments": [], "words": []}
+        if self.response_format in ("srt", "vtt"):
+            return "".join(self.pieces)
+        if self.held is not None:
+            text = "".join(self.pieces + [self.held])
+        else:
+            text = " ".join(self.pieces)
+        if self.response_format == "json":
+            return {"text": text}
+        return text
+
+    def flush(self):
+        """
+        Returns the text held back for stitching, to complete a partial output file.
+        """
+        return self.held or ""
+
+
+def transcript_text(transcription, response_format=None):
+    """
+    Returns the plain text of a merged transcript, whatever its format.
+
+    :param response_format: The format of the transcript; srt and vtt subtitles
+        are reduced to the text of their cues.
+    """
+    if isinstance(transcription, dict):
+        return transcription["text"]
+    if response_format in ("srt", "vtt"):
+        return " ".join(text for _, _, text in parse_cues(transcription) if text)
+    return transcription